@@ -15,9 +15,13 @@ expected_params={	'vmaxref': 'Relative maximum enzymatic decomp rates (length 3)
             'new_resp_units':True,
             }
 
-# Names of the C types. Can edit this to change the number and name of pools in edited model simulations
+# Names of the C types of the default model (default_model). To run with other C types, make a CORPSEModel with them and pass it to the solvers
+# (model=...), rather than editing this list. The dictionary version of the model (CORPSE_deriv) always uses these C types
 chem_types = ['Fast','Slow','Necro']
 
+# Parameters that have a separate value for each C type
+chem_params=['vmaxref','Ea','kC','eup','protection_rate']
+
 # Makes a list of the pools that should actually be in the model, including both protected and unprotected states
 expected_pools = ['u'+t+'C' for t in chem_types]+\
                  ['p'+t+'C' for t in chem_types]+\
@@ -40,7 +44,7 @@ def prot_clay(claypercent,slope=0.4833,intercept=2.3282,BD=1.15,porosity=0.4):
     return prot
 
 # Check if the parameters sent to the model included the correct set of parameters and raise an error if not
-def check_params(params):
+def check_params(params,npoints=None,model=None):
     '''params: dictionary containing parameter values. Should contain these fields (showing reasonable default values):
              vmaxref=[2500,600,2000]; Relative maximum enzymatic decomp rates
              Ea=[37e3,54e3,50e3];     Activation energy
@@ -51,20 +55,72 @@ def check_params(params):
              et=0.5;           Fraction of turnover not converted to CO2
              eup=[0.6,0.05,0.6];  Carbon uptake efficiency
              tProtected=75.0;     Protected C turnover time (years)
-             protection_rate=[1.0,0.0,1.0];  Protected carbon formation rate (year-1)'''
-
-    from numpy import iterable,array
+             protection_rate=[1.0,0.0,1.0];  Protected carbon formation rate (year-1)
+       Parameters with a value for each C type (vmaxref, Ea, kC, eup, protection_rate) are dictionaries keyed by chem_types.
+       Any numerical value can be a scalar or an array with one value per point, for example to run a parameter ensemble in one pass.
+       npoints: Number of points in the simulation. If given (including 1), per-point arrays must have this length.
+                If None, it is set by the per-point arrays, which must all have the same length.
+       model: CORPSEModel whose C types the parameters must have (default is default_model, with the C types in chem_types)
+
+       Lists are converted to arrays in place. Arrays are not copied, so calling this again on the same params is cheap.
+       Returns the number of points implied by the per-point parameters (None if all parameters are scalars).'''
+
+    if model is None:
+        model=default_model
     unused_params=expected_params.copy()
     for k in params.keys():
         if k not in expected_params:
             raise ValueError('Parameter set contains unexpected parameter %s'%k)
         unused_params.pop(k)
-        if iterable(params[k]):
-            params[k]=array(params[k])
+        if k=='new_resp_units':
+            continue
+        if k in chem_params:
+            if not isinstance(params[k],dict):
+                raise ValueError('Parameter %s should be a dictionary with a value for each C type %s'%(k,model.chem_types))
+            for t in model.chem_types:
+                if t not in params[k]:
+                    raise ValueError('Parameter %s is missing a value for C type %s'%(k,t))
+                params[k][t],npoints=check_param_shape(params[k][t],k+'['+t+']',npoints)
+        else:
+            params[k],npoints=check_param_shape(params[k],k,npoints)
     if len(unused_params)>0:
         for k in unused_params.keys():
             print ('Missing parameter: %s [%s]'%(k,unused_params[k]))
         raise ValueError('Missing parameters: %s'%unused_params.keys())
+    return npoints
+
+# Check that a single parameter value is a scalar or an array with one value per point
+def check_param_shape(value,name,npoints):
+    from numpy import iterable,asarray,ndarray
+    if not iterable(value) and not isinstance(value,ndarray):
+        return value,npoints
+    value=asarray(value,dtype=float)
+    if value.ndim==0:
+        return value,npoints
+    if value.ndim>1:
+        raise ValueError('Parameter %s should be a scalar or a 1-D array with one value per point (has shape %s)'%(name,value.shape))
+    if len(value)==1:
+        return value,npoints
+    if npoints is None:
+        npoints=len(value)
+    elif len(value)!=npoints:
+        raise ValueError('Parameter %s has %d values but there are %d points'%(name,len(value),npoints))
+    return value,npoints
+
+# Select the parameter values for one point from a parameter set that may contain per-point arrays
+def point_params(params,point):
+    from numpy import ndim
+    def select(value):
+        if ndim(value)==1 and len(value)>1:
+            return value[point]
+        return value
+    out={}
+    for k in params.keys():
+        if isinstance(params[k],dict):
+            out[k]=dict([(t,select(params[k][t])) for t in params[k].keys()])
+        else:
+            out[k]=select(params[k])
+    return out
 
 # The main model function. Given the current state of the model along with temperature, moisture, and parameters, it calculates the rate of change of all pools
 from numpy import zeros,size,where,atleast_1d
@@ -128,25 +184,21 @@ def CORPSE_deriv(SOM,T,theta,params,claymod=1.0):
 # Decomposition rate
 def decompRate(SOM,T,theta,params):
 
-    # This only really needs to be calculated once
     # This corrects the units of vmaxref for the moisture function, so the units can be in actual 1/time. 
     # This essentially sets the maximum value of the moisture function to 1
-    if params['new_resp_units']:
-        theta_resp_max=params['substrate_diffusion_exp']/(params['gas_diffusion_exp']*(1.0+params['substrate_diffusion_exp']/params['gas_diffusion_exp']))
-        aerobic_max=theta_resp_max**params['substrate_diffusion_exp']*(1.0-theta_resp_max)**params['gas_diffusion_exp']
-
-    else:
-        aerobic_max=1.0
+    # aerobic_max caches the value, so it is only calculated once for a given set of parameters
+    amax=aerobic_max(params)
 
     vmax=Vmax(T,params)
 
     # Decomposition rate of each C type
     decompRate={}
+    sumU=sumCtypes(SOM,'u')
     # Skip the decomposition calculation if there is no carbon or no microbial biomass (to avoid dividing by zero)
-    dodecomp=(sumCtypes(SOM,'u')!=0.0)&(theta!=0.0)&(SOM['livingMicrobeC']!=0.0)
+    dodecomp=(sumU!=0.0)&(theta!=0.0)&(SOM['livingMicrobeC']!=0.0)
     for t in chem_types:
         if dodecomp.any():
-            drate=where(dodecomp,vmax[t]*theta**params['substrate_diffusion_exp']*(SOM['u'+t+'C'])*SOM['livingMicrobeC']/(sumCtypes(SOM,'u')*params['kC'][t]+SOM['livingMicrobeC'])*(1.0-theta)**params['gas_diffusion_exp']/aerobic_max,0.0)
+            drate=where(dodecomp,vmax[t]*theta**params['substrate_diffusion_exp']*(SOM['u'+t+'C'])*SOM['livingMicrobeC']/(sumU*params['kC'][t]+SOM['livingMicrobeC'])*(1.0-theta)**params['gas_diffusion_exp']/amax,0.0)
         decompRate[t]=drate
 
     return decompRate
@@ -171,3 +223,472 @@ def sumCtypes(SOM,prefix):
             out=out+SOM[prefix+t+'C']
 
     return out
+
+
+# Array version of the model
+# State is held in one contiguous (n_pools,n_points) float64 array instead of a dictionary of named pools.
+# Which row holds which pool depends on the C types, and is worked out once by CORPSEModel. The model functions find the rows
+# from the model instead of building pool names, so there are no string lookups while the model runs
+
+class CORPSEModel(object):
+    '''Definition of a model configuration: the C types, and the layout of the state array and parameter arrays that follows from them.
+       chem_types: Names of the C types (e.g. ['Fast','Slow','Necro','Pyrogenic']). Parameters that have a value for each C type
+                   (chem_params) need a value for each of these
+       necro_type: The C type that dead microbial biomass goes to
+
+       Attributes:
+         chem_types, nchem: C types and their number
+         array_pools: Pool names in the order of the rows of the state array
+         fields: Pools used by the solvers (array_pools without originalC, which is only carried along). These are the first rows of the state array
+         pool_index: Dictionary of pool name: row
+         u_rows, p_rows: Slices of the rows of unprotected and protected C (one row per C type, in chem_types order)
+         mic_row, co2_row, necro_row: Rows of living microbial biomass, cumulative CO2 and unprotected necromass
+         n_model_pools: Rows from here on (originalC) have no rate of change
+
+       Everything is set up when the model is created and is not changed afterwards, so different models can be used in the same
+       process and a model can be shared between threads. default_model is the model with the C types in chem_types'''
+
+    def __init__(self,chem_types=('Fast','Slow','Necro'),necro_type='Necro'):
+        chem_types=list(chem_types)
+        if len(set(chem_types))<len(chem_types):
+            raise ValueError('C types must have different names: %s'%chem_types)
+        if necro_type not in chem_types:
+            raise ValueError('Necromass C type %s is not one of the C types %s'%(necro_type,chem_types))
+        self.chem_types=chem_types
+        self.nchem=len(chem_types)
+        self.necro_type=necro_type
+        # Unprotected and protected C types are stored in contiguous rows, so they can be accessed as slices (views) without copying
+        self.array_pools=['u'+t+'C' for t in chem_types]+['p'+t+'C' for t in chem_types]+['livingMicrobeC','CO2','originalC']
+        self.fields=[p for p in self.array_pools if p!='originalC']
+        self.pool_index=dict([(p,n) for n,p in enumerate(self.array_pools)])
+        self.u_rows=slice(0,self.nchem)
+        self.p_rows=slice(self.nchem,2*self.nchem)
+        self.mic_row=self.pool_index['livingMicrobeC']
+        self.co2_row=self.pool_index['CO2']
+        self.necro_row=self.pool_index['u'+necro_type+'C']
+        self.n_model_pools=self.co2_row+1
+
+    def __repr__(self):
+        return 'CORPSEModel(%r)'%(self.chem_types,)
+
+    def cache_key(self):
+        '''Description of the model for CORPSE_cache keys'''
+        return ['CORPSEModel',self.chem_types,self.necro_type]
+
+    def check_params(self,params,npoints=None):
+        return check_params(params,npoints,model=self)
+
+    def array_params(self,params):
+        return array_params(params,model=self)
+
+    def compile(self,params,clay=None,**kwargs):
+        '''CompiledParams for this model. Keyword arguments are passed to CompiledParams'''
+        return CompiledParams(params,clay=clay,model=self,**kwargs)
+
+    def deriv_workspace(self,npoints):
+        return deriv_workspace(npoints,model=self)
+
+    def deriv(self,SOM,T,theta,params,claymod=1.0,out=None,work=None):
+        '''Rates of change of the (n_pools,n_points) state array SOM. Same as CORPSE_deriv_array'''
+        return CORPSE_deriv_array(SOM,T,theta,params,claymod,out=out,work=work,model=self)
+
+    def jacobian(self,SOM,T,theta,params,claymod=1.0):
+        '''Jacobian of deriv. Same as CORPSE_jacobian'''
+        return CORPSE_jacobian(SOM,T,theta,params,claymod,model=self)
+
+    def pools_to_array(self,SOM):
+        return pools_to_array(SOM,self.array_pools)
+
+    def array_to_pools(self,SOM):
+        return array_to_pools(SOM,self.array_pools)
+
+default_model=CORPSEModel(chem_types)
+
+# Layout of the default model, for code written before CORPSEModel. array_pools is separate from expected_pools, so changing that list
+# does not shift the rows
+array_pools=default_model.array_pools
+pool_index=default_model.pool_index
+u_rows=default_model.u_rows
+p_rows=default_model.p_rows
+mic_row=default_model.mic_row
+co2_row=default_model.co2_row
+necro_row=default_model.necro_row
+n_model_pools=default_model.n_model_pools
+
+def array_params(params,model=None):
+    '''Convert a parameter dictionary to the form used by CORPSE_deriv_array.
+       Parameters given per C type (dictionaries keyed by the model's chem_types) are stacked into arrays with one row per C type,
+       so they broadcast against the C type rows of the state array. Call this once per run, not every time step.'''
+    from numpy import array,asarray,broadcast,broadcast_to
+    if model is None:
+        model=default_model
+    out={}
+    for k in params.keys():
+        if k in chem_params:
+            # Values can be scalars or per-point arrays, so broadcast them to a common shape before stacking
+            values=[asarray(params[k][t],dtype=float) for t in model.chem_types]
+            shape=broadcast(*values).shape
+            out[k]=array([broadcast_to(v,shape) for v in values]).reshape(model.nchem,-1)
+        else:
+            out[k]=params[k]
+    return out
+
+def aerobic_max(params):
+    '''Maximum value of the moisture function, used to normalize vmaxref to units of 1/time'''
+    from numpy import ndim
+    if not params['new_resp_units']:
+        return 1.0
+    if ndim(params['substrate_diffusion_exp'])==0 and ndim(params['gas_diffusion_exp'])==0:
+        return aerobic_max_scalar(float(params['substrate_diffusion_exp']),float(params['gas_diffusion_exp']))
+    return calc_aerobic_max(params['substrate_diffusion_exp'],params['gas_diffusion_exp'])
+
+def calc_aerobic_max(substrate_diffusion_exp,gas_diffusion_exp):
+    theta_resp_max=substrate_diffusion_exp/(gas_diffusion_exp*(1.0+substrate_diffusion_exp/gas_diffusion_exp))
+    return theta_resp_max**substrate_diffusion_exp*(1.0-theta_resp_max)**gas_diffusion_exp
+
+# Parameter sets are usually scalars that are reused for every time step, so remember previously calculated values
+from functools import lru_cache
+aerobic_max_scalar=lru_cache(maxsize=128)(calc_aerobic_max)
+
+# Hash of all the values in a parameter set (or any combination of dictionaries, lists, arrays and numbers).
+# The same values always give the same hash, in any process, and changing any value changes it
+def params_fingerprint(params):
+    import hashlib
+    h=hashlib.sha1()
+    update_hash(h,params)
+    return h.hexdigest()
+
+def update_hash(h,value):
+    from numpy import ndarray,generic,ascontiguousarray
+    if isinstance(value,dict):
+        h.update(b'dict')
+        for k in sorted(value.keys(),key=repr):
+            h.update(repr(k).encode())
+            update_hash(h,value[k])
+    elif isinstance(value,(list,tuple)):
+        h.update(b'list%d'%len(value))
+        for v in value:
+            update_hash(h,v)
+    elif isinstance(value,ndarray):
+        h.update(repr((value.dtype.str,value.shape)).encode())
+        h.update(ascontiguousarray(value).data)
+    elif isinstance(value,generic):
+        h.update(repr(value.item()).encode())
+    else:
+        h.update(repr(value).encode())
+
+class CompiledParams(object):
+    '''Parameters compiled once per run for the array version of the model.
+       Holds the array_params form of the parameters, the terms that do not change during a run (aerobic_max and the clay
+       modifier of protection rates), and a table of Vmax values for temperatures that have already been seen.
+
+       params: Parameter dictionary
+       clay: Soil % clay, scalar or one value per point. If None, the clay modifier is 1
+       cache_vmax: Remember Vmax for repeated temperatures. Worth it when temperature is constant or repeats (e.g. an annual cycle of
+                   daily records), but not when every call has a new temperature. Vmax for an array of temperatures is only remembered
+                   when the caller gives a key that identifies it (e.g. the forcing's record index, see vmax)
+       max_cache_bytes: Size limit of the Vmax table. The oldest entries are dropped first
+       model: CORPSEModel the parameters are for (default is default_model). The model functions use this model's layout
+
+       If the parameter dictionary is changed, call refresh() to recompile.
+       The Vmax table is changed by every run, so threads running at the same time should each have their own CompiledParams.'''
+
+    def __init__(self,params,clay=None,cache_vmax=True,max_cache_bytes=64e6,model=None):
+        if model is None:
+            model=default_model
+        self.model=model
+        self.cache_vmax=cache_vmax
+        self.max_cache_bytes=max_cache_bytes
+        self.claymod=1.0
+        self.update(params,clay)
+
+    def update(self,params,clay=None):
+        '''Recompile from params, and recalculate the clay modifier if clay is given. Clears the Vmax table'''
+        self.source=params
+        self.fingerprint=params_fingerprint(params)
+        self.arrays=array_params(params,self.model)
+        self.aerobic_max=aerobic_max(params)
+        self.set_clay(clay)
+        self.clear_vmax()
+
+    def clear_vmax(self):
+        '''Empty the Vmax table. Keys only identify temperatures within one run, so solvers call this before reusing a CompiledParams'''
+        self.vmax_table={}
+        self.vmax_table_bytes=0
+
+    def set_clay(self,clay):
+        '''Recalculate the clay modifier of protection rates (if clay is not None)'''
+        from numpy import asarray
+        if clay is not None:
+            self.claymod=prot_clay(asarray(clay,dtype=float))/prot_clay(20)
+
+    def is_current(self,params=None):
+        '''True if params (default: the dictionary this was compiled from) has the same values that were compiled'''
+        if params is None:
+            params=self.source
+        return params_fingerprint(params)==self.fingerprint
+
+    def refresh(self,params=None,clay=None):
+        '''Recompile only if the parameter values have changed since they were compiled'''
+        if params is None:
+            params=self.source
+        if params is not self.source or not self.is_current(params):
+            self.update(params,clay)
+        else:
+            self.set_clay(clay)
+
+    def vmax(self,T,out,key=None):
+        '''Vmax for each C type and point at temperature T (K). Either written into out, or a cached table that must not be modified
+           key: Hashable value that is the same whenever T is the same (e.g. forcing.key from CORPSE_forcing), so the table is looked up
+                in a time that does not depend on the number of points. Without a key, only scalar temperatures are looked up'''
+        from numpy import ndim,empty,broadcast
+        if not self.cache_vmax:
+            return Vmax_array(T,self.arrays,out)
+        if key is None:
+            if ndim(T)>0:
+                return Vmax_array(T,self.arrays,out)
+            key=float(T)
+        vmax=self.vmax_table.get(key)
+        if vmax is None:
+            vmax=Vmax_array(T,self.arrays,out=empty(broadcast(self.arrays['Ea'],self.arrays['vmaxref'],T).shape))
+            while self.vmax_table and self.vmax_table_bytes+vmax.nbytes>self.max_cache_bytes:
+                self.vmax_table_bytes-=self.vmax_table.pop(next(iter(self.vmax_table))).nbytes
+            self.vmax_table[key]=vmax
+            self.vmax_table_bytes+=vmax.nbytes
+        return vmax
+
+    def columns(self,cols,npoints):
+        '''CompiledParams for the points cols (index array) of a run with npoints points, e.g. the points a solver is still advancing.
+           Per-point values are selected, and the rest are shared. Vmax is not remembered, since the table's keys are for all the points'''
+        import copy
+        from numpy import ndim,shape
+        def select(value):
+            if ndim(value)>0 and npoints>1 and shape(value)[-1]==npoints:
+                return value[...,cols]
+            return value
+        out=copy.copy(self)
+        out.arrays=dict([(k,select(v)) for k,v in self.arrays.items()])
+        out.aerobic_max=select(self.aerobic_max)
+        out.claymod=select(self.claymod)
+        out.cache_vmax=False
+        out.clear_vmax()
+        return out
+
+def deriv_workspace(npoints,model=None):
+    '''Allocate the scratch arrays used by CORPSE_deriv_array. Reuse the same workspace for every call with the same number of points'''
+    from numpy import empty
+    nchem=(model or default_model).nchem
+    return {'theta':empty(npoints),'moisture':empty(npoints),'sumU':empty(npoints),'turnover':empty(npoints),'tmp':empty(npoints),
+            'dodecomp':empty(npoints,dtype=bool),'mask':empty(npoints,dtype=bool),
+            'vmax':empty((nchem,npoints)),'decomp':empty((nchem,npoints)),'flux':empty((nchem,npoints))}
+
+# Pack a dictionary (or DataFrame) of named pools into a state array. Pools missing from SOM are set to zero
+def pools_to_array(SOM,pools=array_pools):
+    from numpy import zeros,atleast_1d,asarray
+    npoints=max([len(atleast_1d(asarray(SOM[f]))) for f in pools if f in SOM])
+    out=zeros((len(pools),npoints))
+    for n,f in enumerate(pools):
+        if f in SOM:
+            out[n,:]=asarray(SOM[f],dtype=float)
+    return out
+
+# Unpack a state array into a dictionary of named pools. The values are views of the rows, not copies
+def array_to_pools(SOM,pools=array_pools):
+    return dict([(f,SOM[n]) for n,f in enumerate(pools)])
+
+def Vmax_array(T,params,out):
+    '''Vmax for each C type (rows) and point (columns), written into out. Same as Vmax, normalized to Tref=293.15
+    T is in K
+    params: output of array_params'''
+
+    Tref=293.15;
+    Rugas=8.314472;
+
+    from numpy import divide,subtract,multiply,exp
+
+    divide(1.0,T,out=out)
+    subtract(out,1.0/Tref,out=out)
+    multiply(out,-1.0/Rugas,out=out)
+    multiply(out,params['Ea'],out=out)
+    exp(out,out=out)
+    multiply(out,params['vmaxref'],out=out)
+    return out
+
+def CORPSE_deriv_array(SOM,T,theta,params,claymod=1.0,out=None,work=None,model=None,vmax_key=None):
+    '''Calculate rates of change for all CORPSE pools, using the array state layout
+       SOM: State array of shape (n_pools,n_points), rows in the model's array_pools order
+       T: Temperature (K), scalar or one value per point
+       theta: Soil water content (fraction of saturation), scalar or one value per point
+       params: CompiledParams, or output of array_params
+       out: Array with the same shape as SOM that the rates of change are written into
+       work: Scratch arrays from deriv_workspace
+       model: CORPSEModel that sets the layout of SOM. Default is the model params were compiled for, or default_model
+       vmax_key: Key for looking up Vmax in the table of a CompiledParams (see CompiledParams.vmax)
+
+       If out and work are supplied, no arrays are allocated. Returns out'''
+
+    from numpy import empty_like,clip,power,subtract,multiply,divide,add,maximum,negative,not_equal,logical_and,logical_not,copyto
+
+    if model is None:
+        model=getattr(params,'model',default_model)
+    if SOM.ndim==1:
+        if out is None:
+            out=empty_like(SOM)
+        CORPSE_deriv_array(SOM[:,None],T,theta,params,claymod,out[:,None],work,model,vmax_key)
+        return out
+    if out is None:
+        out=empty_like(SOM)
+    if work is None:
+        work=deriv_workspace(SOM.shape[1],model)
+
+    if isinstance(params,CompiledParams):
+        amax=params.aerobic_max
+        vmax=params.vmax(T,out=work['vmax'],key=vmax_key)
+        params=params.arrays
+    else:
+        amax=aerobic_max(params)
+        vmax=Vmax_array(T,params,out=work['vmax'])
+
+    u=SOM[model.u_rows]
+    p=SOM[model.p_rows]
+    mic=SOM[model.mic_row]
+
+    theta=clip(theta,0.0,1.0,out=work['theta'])
+    sumU=u.sum(axis=0,out=work['sumU'])
+
+    # Moisture and temperature dependence of decomposition
+    moisture=power(theta,params['substrate_diffusion_exp'],out=work['moisture'])
+    tmp=subtract(1.0,theta,out=work['tmp'])
+    power(tmp,params['gas_diffusion_exp'],out=tmp)
+    multiply(moisture,tmp,out=moisture)
+    divide(moisture,amax,out=moisture)
+
+    # Decomposition rate of each C type (Michaelis-Menten in microbial biomass)
+    # Skip the decomposition calculation if there is no carbon or no microbial biomass (to avoid dividing by zero)
+    dodecomp=not_equal(sumU,0.0,out=work['dodecomp'])
+    mask=work['mask']
+    logical_and(dodecomp,not_equal(theta,0.0,out=mask),out=dodecomp)
+    logical_and(dodecomp,not_equal(mic,0.0,out=mask),out=dodecomp)
+    decomp=multiply(u,mic,out=work['decomp'])
+    multiply(decomp,moisture,out=decomp)
+    multiply(decomp,vmax,out=decomp)
+    denom=multiply(params['kC'],sumU,out=work['flux'])
+    add(denom,mic,out=denom)
+    divide(decomp,denom,out=decomp,where=dodecomp)
+    copyto(decomp,0.0,where=logical_not(dodecomp,out=mask))
+
+    # Microbial turnover
+    turnover=multiply(sumU,params['minMicrobeC'],out=work['turnover'])
+    subtract(mic,turnover,out=turnover)
+    divide(turnover,params['Tmic'],out=turnover)
+    maximum(turnover,0.0,out=turnover)
+
+    dmic=out[model.mic_row]
+    dco2=out[model.co2_row]
+    du=out[model.u_rows]
+    dp=out[model.p_rows]
+
+    # Microbial growth, and CO2 from growth respiration plus maintenance respiration
+    flux=multiply(decomp,params['eup'],out=work['flux'])
+    flux.sum(axis=0,out=dmic)
+    decomp.sum(axis=0,out=dco2)
+    subtract(dco2,dmic,out=dco2)
+    multiply(turnover,params['et'],out=tmp)
+    subtract(dmic,turnover,out=dmic)
+    add(dco2,turnover,out=dco2)
+    subtract(dco2,tmp,out=dco2)
+
+    # Protected carbon formation minus turnover
+    multiply(u,params['protection_rate'],out=dp)
+    multiply(dp,claymod,out=dp)
+    divide(p,params['tProtected'],out=flux)
+    subtract(dp,flux,out=dp)
+    negative(decomp,out=du)
+    subtract(du,dp,out=du)
+
+    # Dead microbial biomass goes to necromass
+    add(out[model.necro_row],tmp,out=out[model.necro_row])
+    out[model.n_model_pools:]=0.0
+
+    return out
+
+def CORPSE_jacobian(SOM,T,theta,params,claymod=1.0,model=None):
+    '''Exact Jacobian of CORPSE_deriv_array with respect to the pools
+       SOM: State array of shape (n_pools,) for one point or (n_pools,n_points) for a stack of points
+       T, theta, params, claymod, model: Same as CORPSE_deriv_array
+
+       Returns J with J[i,j] = d(rate of pool i)/d(pool j), shape (n_pools,n_pools) for one point
+       or (n_points,n_pools,n_pools) for a stack of points'''
+
+    from numpy import zeros,empty,clip,where,broadcast_to,atleast_1d,arange,newaxis
+
+    if model is None:
+        model=getattr(params,'model',default_model)
+    if SOM.ndim==1:
+        return CORPSE_jacobian(SOM[:,None],T,theta,params,claymod,model)[0]
+    if isinstance(params,CompiledParams):
+        params=params.arrays
+    u_rows,p_rows,mic_row,co2_row,necro_row=model.u_rows,model.p_rows,model.mic_row,model.co2_row,model.necro_row
+
+    npools,npoints=SOM.shape
+    nchem=model.nchem
+    shape=(nchem,npoints)
+
+    u=SOM[u_rows]
+    mic=SOM[mic_row]
+    sumU=u.sum(axis=0)
+    theta=clip(atleast_1d(theta),0.0,1.0)
+
+    moisture=theta**params['substrate_diffusion_exp']*(1.0-theta)**params['gas_diffusion_exp']/aerobic_max(params)
+    vmax=Vmax_array(T,params,out=empty(shape))
+
+    # Michaelis-Menten decomposition: decomp_k = A_k*u_k*mic/(kC_k*sumU+mic)
+    # This is smooth wherever the denominator is nonzero, including zero biomass (e.g. after a fire kills all microbes),
+    # so only points with a zero denominator are masked. Dry soil (theta=0) is handled by moisture being zero
+    kC=broadcast_to(params['kC'],shape)
+    denom=kC*sumU+mic
+    dodecomp=denom!=0.0
+    denom=where(dodecomp,denom,1.0)
+    A=where(dodecomp,vmax*moisture,0.0)
+    # d(decomp_k)/d(u_j) = diag_k*delta_kj - offdiag_k
+    diag=A*mic/denom
+    offdiag=A*mic*u*kC/denom**2
+    ddecomp_du=-offdiag.T[:,:,newaxis]+zeros((npoints,nchem,nchem))
+    ddecomp_du[:,arange(nchem),arange(nchem)]+=diag.T
+    ddecomp_dmic=(A*u*kC*sumU/denom**2).T
+
+    # Microbial turnover is clamped at zero, so it only has a derivative where it is positive
+    active=((mic-params['minMicrobeC']*sumU)>0.0)/(zeros(npoints)+params['Tmic'])
+    dturnover_du=-(zeros(npoints)+params['minMicrobeC'])*active
+    dturnover_dmic=active
+
+    eup=broadcast_to(params['eup'],shape).T
+    et=zeros(npoints)+params['et']
+    protection=(broadcast_to(params['protection_rate'],shape)*claymod).T
+    release=zeros(npoints)+1.0/params['tProtected']
+
+    J=zeros((npoints,npools,npools))
+    iu=arange(u_rows.start,u_rows.stop)
+    ip=arange(p_rows.start,p_rows.stop)
+
+    # Unprotected C
+    J[:,u_rows,u_rows]=-ddecomp_du
+    J[:,iu,iu]-=protection
+    J[:,iu,ip]=release[:,newaxis]
+    J[:,u_rows,mic_row]=-ddecomp_dmic
+    J[:,necro_row,u_rows]+=(et*dturnover_du)[:,newaxis]
+    J[:,necro_row,mic_row]+=et*dturnover_dmic
+
+    # Protected C
+    J[:,ip,iu]=protection
+    J[:,ip,ip]=-release[:,newaxis]
+
+    # Microbial biomass
+    J[:,mic_row,u_rows]=(eup[:,:,newaxis]*ddecomp_du).sum(axis=1)-dturnover_du[:,newaxis]
+    J[:,mic_row,mic_row]=(eup*ddecomp_dmic).sum(axis=1)-dturnover_dmic
+
+    # CO2
+    J[:,co2_row,u_rows]=((1.0-eup)[:,:,newaxis]*ddecomp_du).sum(axis=1)+((1.0-et)*dturnover_du)[:,newaxis]
+    J[:,co2_row,mic_row]=((1.0-eup)*ddecomp_dmic).sum(axis=1)+(1.0-et)*dturnover_dmic
+
+    return J
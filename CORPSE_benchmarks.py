@@ -0,0 +1,395 @@
+# This script measures the speed, memory use and accuracy of the model and solvers, so changes in performance show up
+# before upgrading packages or merging changes to the model code.
+#
+# Benchmarks:
+#   deriv:    Time per call of the rate calculation (CORPSE_deriv on a dictionary of pools, CORPSE_deriv_array, and the numba kernel
+#             if numba is installed) for different numbers of points
+#   solvers:  Time for run_models_ODE (odeint loop and batched) and run_models_iterator (numpy and numba backends) for different
+#             numbers of sites and lengths of simulation
+#   memory:   Peak memory of each solver. Each case runs in a separate process, so the peak resident set size (RSS) is for that case only.
+#             Also reports the peak of memory allocated through python and numpy (tracemalloc)
+#   accuracy: Error of each solver compared with a reference run of the batched ODE solver with very tight tolerances
+#   startup:  Cold start time of a new process: importing CORPSE_solvers and CORPSE_cli, and a small run through the command line
+#             interface (CORPSE_cli), which includes importing scipy. Also checks that none of these load pandas or matplotlib.
+#             A case fails if it takes longer than --startup-budget seconds or loads either of them
+#
+# Sites are synthetic: each one is given one of the microbial functional types from Whitman_sims.py (initial pools and parameters),
+# with random climate and clay content. The same seed always gives the same sites.
+#
+# Like asv, each timing is the best of several repeats, and results can be saved to a JSON file and compared with a previous run:
+#   python CORPSE_benchmarks.py --save before.json
+#   (change something)
+#   python CORPSE_benchmarks.py --compare before.json
+# The comparison lists cases that got slower, used more memory, or became less accurate by more than --threshold (a fraction)
+
+import CORPSE_array as CORPSE_deriv
+import CORPSE_solvers
+
+# Benchmark sizes. 'quick' runs in about a minute. 'full' covers 1 to 100000 sites and 1 to 100 years, and takes hours
+suites={
+    'quick':{'deriv_points':[1,100,10000],
+             'solver_sites':[1,100,1000],'solver_years':[1,10],
+             'memory_sites':[1000],'memory_years':10,
+             'accuracy_sites':20,'accuracy_years':5},
+    'full': {'deriv_points':[1,10,100,1000,10000,100000],
+             'solver_sites':[1,100,10000,100000],'solver_years':[1,10,100],
+             'memory_sites':[10000,100000],'memory_years':10,
+             'accuracy_sites':100,'accuracy_years':100},
+}
+
+# The odeint loop takes one call per site, so it is only run for up to this many sites
+max_loop_sites=100
+
+# Make a set of synthetic sites from the Whitman_sims functional types
+# Returns a dictionary with the arguments that the solvers need: params (with one value per site for parameters that differ
+# between functional types), initvals (DataFrame with one row per site), Tmin, Tmax, thetamin, thetamax, clay, inputs,
+# and functype (name of each site's functional type)
+def synthetic_sites(nsites,seed=0):
+    import Whitman_sims
+    from numpy import array
+    from numpy.random import default_rng
+    from pandas import DataFrame
+    rng=default_rng(seed)
+    names=list(Whitman_sims.paramsets.keys())
+    functype=rng.integers(0,len(names),nsites)
+
+    def per_site(values):
+        values=array([float(v) for v in values])
+        if (values==values[0]).all():
+            return values[0]
+        return values[functype]
+
+    params={}
+    for k,v in Whitman_sims.params.items():
+        if isinstance(v,dict):
+            params[k]=dict([(t,per_site([Whitman_sims.paramsets[n][k][t] for n in names])) for t in v.keys()])
+        elif isinstance(v,bool):
+            params[k]=v
+        else:
+            params[k]=per_site([Whitman_sims.paramsets[n][k] for n in names])
+
+    initvals=DataFrame(dict([(f,array([float(Whitman_sims.initvals[n][f]) for n in names])[functype]) for f in Whitman_sims.SOM_init.keys()]))
+    Tmin=rng.uniform(-5.0,15.0,nsites)
+    return {'params':params,'initvals':initvals,'Tmin':Tmin,'Tmax':Tmin+rng.uniform(5.0,20.0,nsites),
+            'thetamin':rng.uniform(0.2,0.4,nsites),'thetamax':rng.uniform(0.5,0.8,nsites),'clay':rng.uniform(5.0,50.0,nsites),
+            'inputs':{'uFastC':0.4,'uSlowC':0.6},'functype':[names[n] for n in functype]}
+
+# Best time (seconds) of repeat calls of func, each of which calls it number times. Output printed by the solvers is hidden
+def best_time(func,repeat=3,number=1):
+    import time,io,contextlib
+    best=float('inf')
+    for r in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0=time.perf_counter()
+            for n in range(number):
+                func()
+            best=min(best,(time.perf_counter()-t0)/number)
+    return best
+
+# Run one solver on a set of sites. Output times are monthly for the ODE solvers. The iterator uses daily steps and keeps
+# the pools at the end of each month, so memory use does not depend on the time step
+def run_solver(solver,sites,years):
+    import CORPSE_output
+    from numpy import arange
+    args=(sites['Tmin'],sites['Tmax'],sites['thetamin'],sites['thetamax'])
+    kwargs={'inputs':sites['inputs'],'params':sites['params'],'clay':sites['clay'],'initvals':sites['initvals']}
+    if solver=='ode_loop':
+        return CORPSE_solvers.run_models_ODE(*args,times=arange(0,years+1e-9,1/12),**kwargs)
+    elif solver=='ode_batched':
+        return CORPSE_solvers.run_models_ODE(*args,times=arange(0,years+1e-9,1/12),batched=True,**kwargs)
+    elif solver in ['iterator_numpy','iterator_numba']:
+        sink=CORPSE_output.AggregateOutput(period=1/12,how='last')
+        return CORPSE_solvers.run_models_iterator(*args,times=arange(0,years,1/365),sink=sink,backend=solver.split('_')[1],**kwargs)
+    else:
+        raise ValueError('Unknown solver %s'%solver)
+
+def solver_names(nsites):
+    import CORPSE_kernels
+    names=['ode_batched','iterator_numpy']
+    if nsites<=max_loop_sites:
+        names.insert(0,'ode_loop')
+    if CORPSE_kernels.available:
+        names.append('iterator_numba')
+    return names
+
+# Time per call of the rate calculation
+def bench_deriv(points,repeat=5):
+    import CORPSE_kernels
+    from numpy import zeros,empty,empty_like,broadcast_to,asarray
+    results=[]
+    for npoints in points:
+        sites=synthetic_sites(npoints)
+        T=asarray(sites['Tmin'])+273.15
+        theta=asarray(sites['thetamin'])
+        compiled=CORPSE_deriv.CompiledParams(sites['params'],clay=sites['clay'],cache_vmax=False)
+        SOM=CORPSE_deriv.pools_to_array(sites['initvals'])
+        pools=CORPSE_deriv.array_to_pools(SOM)
+        out=empty_like(SOM)
+        work=CORPSE_deriv.deriv_workspace(npoints)
+        # Enough calls per repeat that small cases are not dominated by timer resolution
+        number=max(1,min(1000,100000//npoints))
+        cases=[('deriv_dict',lambda: CORPSE_deriv.CORPSE_deriv(pools,T,theta,sites['params'],compiled.claymod)),
+               ('deriv_array',lambda: CORPSE_deriv.CORPSE_deriv_array(SOM,T,theta,compiled,compiled.claymod,out=out,work=work))]
+        if CORPSE_kernels.available:
+            kp=CORPSE_kernels.kernel_params(compiled,npoints)
+            inputs=broadcast_to(zeros((len(SOM),1)),SOM.shape)
+            vmax=empty((len(CORPSE_deriv.chem_types),npoints))
+            moisture=empty(npoints)
+            def numba_rates():
+                CORPSE_kernels.moisture_array(theta,compiled.arrays,compiled.aerobic_max,out=moisture)
+                CORPSE_kernels.rates(SOM,CORPSE_deriv.Vmax_array(T,compiled.arrays,out=vmax),moisture,inputs,kp,CORPSE_kernels.layout,out)
+            numba_rates()   # Compile before timing
+            cases.append(('deriv_numba',numba_rates))
+        for name,func in cases:
+            t=best_time(func,repeat,number)
+            results.append({'name':name,'params':{'points':npoints},'time':t,'time_per_point':t/npoints})
+            print('%-16s points=%-7d %10.1f us/call %8.3f us/point'%(name,npoints,t*1e6,t/npoints*1e6))
+    return results
+
+# Time for whole simulations
+def bench_solvers(sites_list,years_list,repeat=3):
+    results=[]
+    for nsites in sites_list:
+        sites=synthetic_sites(nsites)
+        for years in years_list:
+            for solver in solver_names(nsites):
+                if solver=='iterator_numba':
+                    best_time(lambda: run_solver(solver,synthetic_sites(1),0.01),1)   # Compile before timing
+                # Long runs are only repeated once
+                t=best_time(lambda: run_solver(solver,sites,years),repeat if nsites*years<=1000 else 1)
+                results.append({'name':solver,'params':{'sites':nsites,'years':years},'time':t,'site_years_per_s':nsites*years/t})
+                print('%-16s sites=%-7d years=%-4d %10.3f s %12.0f site-years/s'%(solver,nsites,years,t,nsites*years/t))
+    return results
+
+# Peak memory of one solver run. Runs in a worker process (see bench_memory)
+def memory_task(task):
+    import tracemalloc,io,contextlib
+    solver,nsites,years=task
+    sites=synthetic_sites(nsites)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if solver=='iterator_numba':
+            run_solver(solver,synthetic_sites(1),0.01)
+        rss_before=max_rss()
+        tracemalloc.start()
+        run_solver(solver,sites,years)
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak,rss_before,max_rss()
+
+# Peak resident set size of this process in bytes, or None where the resource module is not available (Windows)
+def max_rss():
+    import sys
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return rss if sys.platform=='darwin' else rss*1024
+
+def bench_memory(sites_list,years):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    results=[]
+    for nsites in sites_list:
+        for solver in solver_names(nsites):
+            # A new (spawned, not forked) process for each case, so the peak RSS is not left over from an earlier case
+            with ProcessPoolExecutor(max_workers=1,mp_context=multiprocessing.get_context('spawn')) as pool:
+                peak,rss_before,rss=pool.submit(memory_task,(solver,nsites,years)).result()
+            result={'name':solver+'_memory','params':{'sites':nsites,'years':years},'peak_mb':peak/1e6}
+            if rss is not None:
+                result['rss_mb']=rss/1e6
+                result['rss_growth_mb']=(rss-rss_before)/1e6
+            results.append(result)
+            print('%-23s sites=%-7d years=%-4d traced peak %8.1f MB  RSS %s MB'%(result['name'],nsites,years,peak/1e6,
+                  '%.1f'%result['rss_mb'] if rss is not None else 'n/a'))
+    return results
+
+# Error of each solver compared with a reference run using very tight tolerances, at daily output times
+# Error is the largest difference in total C or cumulative CO2 at any site and time, relative to the initial total C of the site.
+# The iterator holds temperature and moisture constant over each step, so its error includes that as well as the time stepping error.
+# Its output at index k is the state after advancing from times[k] to times[k+1], so it is compared with the reference at times[k+1]
+def bench_accuracy(nsites,years):
+    import io,contextlib
+    from numpy import arange,abs,array
+    sites=synthetic_sites(nsites)
+    times=arange(0,years,1/365)
+    fields=CORPSE_solvers.fields
+    ivals=CORPSE_solvers.initvals_array(sites['initvals'],nsites)
+    args=(sites['Tmin'],sites['Tmax'],sites['thetamin'],sites['thetamax'],times,sites['inputs'],sites['params'],sites['clay'])
+    reference=CORPSE_solvers.integrate_batched(*args,ivals,rtol=1e-11,atol=1e-11)
+    def totals(result):
+        # result has shape (nsites,ntimes,nfields)
+        C=sum(result[:,:,fields.index(f)] for f in fields if f!='CO2')
+        return C,result[:,:,fields.index('CO2')]
+    ref_C,ref_CO2=totals(reference)
+    scale=ref_C[:,:1]
+
+    cases=[('ode_batched',{'batched':True})]
+    if nsites<=max_loop_sites:
+        cases.insert(0,('ode_loop',{}))
+    cases+=[('iterator_euler',{'scheme':'euler'}),('iterator_rk4',{'scheme':'rk4'}),('iterator_rk45',{'scheme':'rk45'}),
+            ('iterator_rosenbrock',{'scheme':'rosenbrock'})]
+    results=[]
+    for name,kwargs in cases:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if name.startswith('ode'):
+                out=CORPSE_solvers.run_models_ODE(*args,initvals=sites['initvals'],**kwargs)
+            else:
+                out=CORPSE_solvers.run_models_iterator(*args,initvals=sites['initvals'],**kwargs)
+        result=array([df[fields].values for df in out])
+        if name.startswith('ode'):
+            C,CO2=totals(result)
+            rC,rCO2=ref_C,ref_CO2
+        else:
+            C,CO2=totals(result[:,:-1])
+            rC,rCO2=ref_C[:,1:],ref_CO2[:,1:]
+        error=max((abs(C-rC)/scale).max(),(abs(CO2-rCO2)/scale).max())
+        results.append({'name':name+'_accuracy','params':{'sites':nsites,'years':years},'error':float(error)})
+        print('%-28s sites=%-5d years=%-4d max relative error %9.2e'%(name,nsites,years,error))
+    return results
+
+# Cold start of a new process for each case. Times are measured inside the process from before the first import (so the
+# python interpreter's own startup is not included), and are the best of repeat processes
+startup_cases={
+    'import_solvers':'import CORPSE_solvers',
+    'import_cli':'import CORPSE_cli',
+    'cli_run':'import CORPSE_cli,io,contextlib\nwith contextlib.redirect_stdout(io.StringIO()): CORPSE_cli.main(["run",%r,"--output",%r])',
+}
+startup_script='''import time,sys,json
+t0=time.perf_counter()
+%s
+t=time.perf_counter()-t0
+print(json.dumps({"time":t,"heavy":sorted(set(m.split(".")[0] for m in sys.modules)&set(["pandas","matplotlib"]))}))'''
+
+# Configuration for the cli_run case: one year of the Whitman_sims functional types at monthly output times
+def startup_config(output):
+    import Whitman_sims
+    names=list(Whitman_sims.paramsets.keys())
+    return {'output':output,'times':{'start':0.0,'end':1.0,'step':1/12},'params':Whitman_sims.params,'inputs':{'uFastC':0.4,'uSlowC':0.6},
+            'initvals':dict([(f,[float(Whitman_sims.initvals[n][f]) for n in names]) for f in Whitman_sims.SOM_init.keys()]),
+            'Tmin':5.0,'Tmax':20.0,'thetamin':0.4,'thetamax':0.6,'clay':20.0}
+
+def bench_startup(budget,repeat=3):
+    import os,sys,json,subprocess,tempfile
+    results=[]
+    with tempfile.TemporaryDirectory() as tmp:
+        config=os.path.join(tmp,'config.json')
+        with open(config,'w') as f:
+            json.dump(startup_config(os.path.join(tmp,'results')),f)
+        for name,code in startup_cases.items():
+            if name=='cli_run':
+                code=code%(config,os.path.join(tmp,'results'))
+            best=float('inf')
+            for r in range(repeat):
+                out=subprocess.run([sys.executable,'-c',startup_script%code],capture_output=True,text=True,check=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+                measured=json.loads(out.stdout.strip().split('\n')[-1])
+                best=min(best,measured['time'])
+            results.append({'name':'startup_'+name,'params':{},'time':best,'heavy_modules':measured['heavy'],'budget':budget})
+            status='ok' if best<=budget and not measured['heavy'] else 'FAILED'
+            print('%-28s %9.3f s (budget %g s)%s  %s'%('startup_'+name,best,budget,
+                  '  loads '+','.join(measured['heavy']) if measured['heavy'] else '',status))
+    return results
+
+# Startup cases that took longer than their budget or loaded pandas or matplotlib
+def startup_failures(results):
+    return [r for r in results if r['name'].startswith('startup_') and (r['time']>r['budget'] or r['heavy_modules'])]
+
+# Information about the environment, saved with the results so runs on different machines or package versions can be told apart
+def environment():
+    import sys,platform,subprocess,datetime,numpy,scipy,pandas,os
+    env={'python':platform.python_version(),'numpy':numpy.__version__,'scipy':scipy.__version__,'pandas':pandas.__version__,
+         'platform':platform.platform(),'processor':platform.processor(),'cpus':os.cpu_count(),
+         'date':datetime.datetime.now().isoformat(timespec='seconds')}
+    try:
+        import numba
+        env['numba']=numba.__version__
+    except ImportError:
+        env['numba']=None
+    try:
+        env['commit']=subprocess.run(['git','rev-parse','HEAD'],capture_output=True,text=True,
+                                     cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        env['commit']=None
+    return env
+
+# Measured values that are compared between runs. For all of these, larger is worse
+compare_keys=['time','peak_mb','rss_growth_mb','error']
+
+# Compare results with a previous run. Returns a list of (name,params,key,old,new) for cases that got worse by more than threshold
+def compare(old,new,threshold=0.2):
+    def key(r):
+        return (r['name'],tuple(sorted(r['params'].items())))
+    previous=dict([(key(r),r) for r in old['results']])
+    worse=[]
+    print('\n%-28s %-28s %-14s %12s %12s %8s'%('Benchmark','Case','Measure','Before','After','Ratio'))
+    for r in new['results']:
+        if key(r) not in previous:
+            continue
+        p=previous[key(r)]
+        for k in compare_keys:
+            if k not in r or k not in p:
+                continue
+            ratio=r[k]/p[k] if p[k]>0 else float('inf') if r[k]>0 else 1.0
+            flag=''
+            # Errors near rounding level change a lot in relative terms without mattering, so ignore errors below 1e-12
+            if ratio>1+threshold and not (k=='error' and r[k]<1e-12):
+                worse.append((r['name'],r['params'],k,p[k],r[k]))
+                flag=' WORSE'
+            elif ratio<1/(1+threshold):
+                flag=' better'
+            case=' '.join('%s=%s'%(a,b) for a,b in sorted(r['params'].items()))
+            print('%-28s %-28s %-14s %12.4g %12.4g %8.2f%s'%(r['name'],case,k,p[k],r[k],ratio,flag))
+    if worse:
+        print('\n%d measurements got worse by more than %d%%'%(len(worse),threshold*100))
+    else:
+        print('\nNo measurements got worse by more than %d%%'%(threshold*100))
+    return worse
+
+def main(argv=None):
+    import argparse,json,sys
+    parser=argparse.ArgumentParser(description='Benchmarks for CORPSE model speed, memory use and accuracy')
+    parser.add_argument('--suite',choices=list(suites.keys()),default='quick',help='Set of benchmark sizes (default: quick)')
+    parser.add_argument('--benchmarks',default='deriv,solvers,memory,accuracy,startup',help='Comma-separated list of benchmarks to run')
+    parser.add_argument('--repeat',type=int,default=3,help='Number of repeats for each timing (the best is kept)')
+    parser.add_argument('--save',help='Save results to this JSON file')
+    parser.add_argument('--compare',help='Compare results with a previous run saved with --save')
+    parser.add_argument('--threshold',type=float,default=0.2,help='Fractional change counted as worse when comparing (default: 0.2)')
+    parser.add_argument('--startup-budget',type=float,default=1.0,help='Longest allowed time of each startup case in seconds (default: 1.0)')
+    args=parser.parse_args(argv)
+
+    suite=suites[args.suite]
+    benchmarks=args.benchmarks.split(',')
+    for b in benchmarks:
+        if b not in ['deriv','solvers','memory','accuracy','startup']:
+            parser.error('Unknown benchmark %s'%b)
+    results=[]
+    if 'deriv' in benchmarks:
+        results+=bench_deriv(suite['deriv_points'],repeat=max(args.repeat,5))
+    if 'solvers' in benchmarks:
+        results+=bench_solvers(suite['solver_sites'],suite['solver_years'],repeat=args.repeat)
+    if 'memory' in benchmarks:
+        results+=bench_memory(suite['memory_sites'],suite['memory_years'])
+    if 'accuracy' in benchmarks:
+        results+=bench_accuracy(suite['accuracy_sites'],suite['accuracy_years'])
+    if 'startup' in benchmarks:
+        results+=bench_startup(args.startup_budget,repeat=args.repeat)
+
+    output={'suite':args.suite,'environment':environment(),'results':results}
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump(output,f,indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            old=json.load(f)
+        if compare(old,output,args.threshold):
+            return 1
+    if startup_failures(results):
+        print('\nStartup is over budget or loads pandas or matplotlib')
+        return 1
+    return 0
+
+if __name__=='__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# This file holds a cache of simulation results on local disk, so a scenario that has already been run is loaded instead of solved again
+# Results are stored under a key that is a hash of everything that determines them (parameters, initial pools, times, forcing and
+# solver settings), so any change to the inputs gives a different key and a stale result can never be returned.
+# Pass a ResultCache to run_models_ODE (cache=...) to use it.
+#
+# Each cached result is a result store (see CORPSE_output), so it is loaded as memory-mapped arrays and only the parts that are used are read.
+# The cache directory holds one store directory per key. New results are written to a temporary directory and renamed into place,
+# so other processes using the same cache never see a partly written result. When the cache grows past its size limit,
+# the results that were used least recently are removed.
+
+import CORPSE_array as CORPSE_deriv
+
+
+class ResultCache(object):
+    '''Cache of simulation results in a directory on local disk
+       path: Cache directory (created if needed). Can be shared by several processes
+       max_bytes: Size limit of the cache. After a result is added, the least recently used results are removed until the cache is under it
+
+       Results are looked up with get(key) and stored with put(key,results,times), where key is from key(...)'''
+
+    def __init__(self,path,max_bytes=1e9):
+        import os
+        self.path=path
+        self.max_bytes=max_bytes
+        self.hits=0
+        self.misses=0
+        os.makedirs(path,exist_ok=True)
+
+    def key(self,*parts):
+        '''Key for a result determined by parts (parameter dictionaries, arrays, DataFrames, numbers, strings, forcing objects, ...).
+           Returns None if any part cannot be hashed reliably (e.g. forcing streamed from a file or calculated by a function)'''
+        try:
+            return CORPSE_deriv.params_fingerprint(cache_value(list(parts)))
+        except TypeError:
+            return None
+
+    def entry(self,key):
+        import os
+        return os.path.join(self.path,key)
+
+    def get(self,key):
+        '''ResultStore of the result for key, or None if it is not in the cache. Marks the result as used'''
+        import os,CORPSE_output
+        entry=self.entry(key)
+        try:
+            store=CORPSE_output.ResultStore(entry)
+            os.utime(os.path.join(entry,'meta.json'))
+        except (OSError,ValueError):
+            # Missing, or removed by another process while it was being read
+            self.misses+=1
+            return None
+        self.hits+=1
+        return store
+
+    def put(self,key,results,times=None):
+        '''Store results (anything CORPSE_output.write_results accepts) under key, and return them as a ResultStore (None if they do not fit in the cache)'''
+        import os,shutil,uuid,CORPSE_output
+        entry=self.entry(key)
+        tmp=os.path.join(self.path,'tmp-%s-%s'%(key,uuid.uuid4().hex))
+        CORPSE_output.write_results(tmp,results,times=times)
+        try:
+            os.rename(tmp,entry)
+        except OSError:
+            # Another process stored the same result first. Both are the same, so keep that one
+            shutil.rmtree(tmp,ignore_errors=True)
+        self.evict()
+        if not os.path.isdir(entry):
+            # Larger than the whole cache, so it was removed straight away
+            return None
+        return CORPSE_output.ResultStore(entry)
+
+    def entries(self):
+        '''List of (last used time,size in bytes,key) of every cached result'''
+        import os
+        out=[]
+        for key in os.listdir(self.path):
+            entry=self.entry(key)
+            if key.startswith('tmp-') or not os.path.isdir(entry):
+                continue
+            try:
+                used=os.stat(os.path.join(entry,'meta.json')).st_mtime
+                size=sum(os.stat(os.path.join(entry,f)).st_size for f in os.listdir(entry))
+            except OSError:
+                continue
+            out.append((used,size,key))
+        return out
+
+    def size(self):
+        '''Total size of the cached results (bytes)'''
+        return sum(size for used,size,key in self.entries())
+
+    def evict(self):
+        '''Remove the least recently used results until the cache is under max_bytes'''
+        import shutil
+        entries=sorted(self.entries())
+        total=sum(size for used,size,key in entries)
+        for used,size,key in entries:
+            if total<=self.max_bytes:
+                break
+            shutil.rmtree(self.entry(key),ignore_errors=True)
+            total-=size
+
+    def clear(self):
+        '''Remove every cached result'''
+        import shutil
+        for used,size,key in self.entries():
+            shutil.rmtree(self.entry(key),ignore_errors=True)
+
+
+# Convert a value to the dictionaries, lists, arrays and plain values that params_fingerprint hashes
+# Numbers, numeric arrays and lists of numbers all become float arrays, so the same values give the same key however they
+# were given (e.g. clay=20 or clay=20.0, or a parameter given as a list that check_params has since turned into an array).
+# Objects (forcing, disturbance schedules, models) provide cache_key(), which returns None if they cannot be cached.
+# Raises TypeError for anything that cannot be hashed reliably
+def cache_value(value):
+    from numpy import ndarray,generic,number,bool_,asarray
+    if hasattr(value,'cache_key'):
+        key=value.cache_key()
+        if key is None:
+            raise TypeError('%s cannot be cached'%type(value).__name__)
+        return cache_value(key)
+    if isinstance(value,dict):
+        return dict([(k,cache_value(v)) for k,v in value.items()])
+    if isinstance(value,(bool,bool_)):
+        return bool(value)
+    if isinstance(value,(int,float,number)):
+        return asarray(value,dtype=float)
+    if isinstance(value,ndarray) and value.dtype.kind in 'iuf':
+        return asarray(value,dtype=float)
+    if isinstance(value,(list,tuple)):
+        if all(isinstance(v,(int,float,number,list,tuple,ndarray)) and not isinstance(v,(bool,bool_)) for v in value):
+            try:
+                values=asarray(value)
+            except ValueError:
+                values=None
+            if values is not None and values.dtype.kind in 'iuf':
+                return asarray(values,dtype=float)
+        return [cache_value(v) for v in value]
+    if isinstance(value,(ndarray,generic,str,bytes,type(None))):
+        return value
+    # pandas DataFrames and Series, without importing pandas
+    if hasattr(value,'to_numpy') and hasattr(value,'index'):
+        return [type(value).__name__,cache_value(list(getattr(value,'columns',[]))),asarray(value.index),value.to_numpy()]
+    raise TypeError('Values of type %s cannot be cached'%type(value).__name__)
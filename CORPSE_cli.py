@@ -0,0 +1,120 @@
+# Command line interface for running the model from a configuration file. Installed as the corpse command (see pyproject.toml):
+#   corpse run config.yaml
+# or without installing:
+#   python CORPSE_cli.py run config.yaml
+#
+# Results are written to a result store (see CORPSE_output) as arrays, so only numpy and scipy are imported to run the model.
+# pandas and matplotlib are never loaded, which keeps startup short for short-lived worker processes.
+#
+# The configuration file is YAML (if PyYAML is installed) or JSON, with these keys:
+#   output:     Directory of the result store to write (can also be given with --output)
+#   solver:     'ode' (batched ODE integrator, the default) or 'iterator' (explicit iterator)
+#   times:      List of output times (years), or {'start':..., 'end':..., 'step':...} (end is included)
+#   params:     Model parameters, as for the solvers. Values can be lists with one value per site
+#   initvals:   Initial value of each pool (a value for every pool in the model's fields), scalars or one value per site
+#   inputs:     C input rates of pools (optional, default is no inputs)
+#   Tmin,Tmax,thetamin,thetamax,clay: Climate and clay content, scalars or one value per site
+#   site_ids:   IDs of the sites (optional)
+#   method:     ODE method (default LSODA)
+#   scheme,substeps,backend: Time stepping of the iterator (defaults euler, 1, numpy)
+#   fires:      Fire schedule (optional): the arguments of CORPSE_disturbance.FireSchedule, e.g. {'fire_times':[10,20],'combustion':0.3}
+#   chem_types: C types of the model (optional, default is the standard Fast, Slow and Necro)
+
+# Read a configuration file. YAML needs PyYAML, which is only imported here. JSON is a subset of YAML, so without PyYAML
+# JSON files (of any extension) can still be read
+def read_config(path):
+    import json
+    with open(path) as f:
+        text=f.read()
+    if path.endswith('.json'):
+        return json.loads(text)
+    try:
+        import yaml
+    except ImportError:
+        try:
+            return json.loads(text)
+        except ValueError:
+            raise ValueError('%s is not JSON, and reading YAML needs PyYAML (pip install pyyaml)'%path)
+    return yaml.safe_load(text)
+
+# Output times from the times entry of a configuration
+def config_times(times):
+    from numpy import arange,asarray
+    if isinstance(times,dict):
+        return arange(times.get('start',0.0),times['end']+times['step']*1e-6,times['step'])
+    return asarray(times,dtype=float)
+
+# Convert lists in a configuration (nested dictionaries of parameters or pools) to arrays
+def config_arrays(value):
+    from numpy import asarray
+    if isinstance(value,dict):
+        return dict([(k,config_arrays(v)) for k,v in value.items()])
+    if isinstance(value,list):
+        return asarray(value,dtype=float)
+    return value
+
+# Run the simulation described by a configuration dictionary and write the results to a result store
+# Returns the CORPSE_output.ResultStore
+def run(config,output=None):
+    import time
+    import CORPSE_array,CORPSE_solvers,CORPSE_output
+    from numpy import atleast_1d,broadcast_to,asarray
+    t0=time.time()
+    output=output or config.get('output')
+    if not output:
+        raise ValueError('No output directory (give output in the configuration or --output)')
+    model=CORPSE_array.CORPSEModel(config['chem_types']) if 'chem_types' in config else CORPSE_array.default_model
+    times=config_times(config['times'])
+    params=config_arrays(config['params'])
+    initvals=config_arrays(config['initvals'])
+    inputs=config.get('inputs',{})
+    missing=[f for f in model.fields if f not in initvals]
+    if missing:
+        raise ValueError('No initial values for pools %s'%missing)
+
+    # Every site needs its own climate and clay values, so broadcast them to the number of sites
+    climate=dict([(k,asarray(config.get(k,d),dtype=float)) for k,d in [('Tmin',20.0),('Tmax',20.0),('thetamin',0.5),('thetamax',0.5),('clay',20.0)]])
+    npoints=max([atleast_1d(v).size for v in climate.values()]+[atleast_1d(initvals[f]).size for f in model.fields])
+    # Parameters with one value per site can also set the number of sites
+    npoints=CORPSE_array.check_params(params,npoints if npoints>1 else None,model) or npoints
+    climate=dict([(k,broadcast_to(v,(npoints,)).copy()) for k,v in climate.items()])
+    disturbance=None
+    if 'fires' in config:
+        import CORPSE_disturbance
+        disturbance=CORPSE_disturbance.FireSchedule(model=model,**config_arrays(config['fires']))
+
+    solver=config.get('solver','ode')
+    print('Running %d sites, %d times with the %s solver'%(npoints,len(times),solver))
+    if solver=='ode':
+        ivals=CORPSE_solvers.initvals_array(initvals,npoints,model)
+        result=CORPSE_solvers.integrate_batched(climate['Tmin'],climate['Tmax'],climate['thetamin'],climate['thetamax'],times,inputs,params,climate['clay'],ivals,
+                                                method=config.get('method','LSODA'),disturbance=disturbance,model=model)
+        store=CORPSE_output.write_results(output,dict([(f,result[:,:,n]) for n,f in enumerate(model.fields)]),site_ids=config.get('site_ids'),times=times)
+    elif solver=='iterator':
+        ivals=dict([(f,broadcast_to(asarray(initvals[f],dtype=float),(npoints,)).copy()) for f in model.fields])
+        sink=CORPSE_output.StoreOutput(output,site_ids=config.get('site_ids'))
+        store=CORPSE_solvers.run_models_iterator(climate['Tmin'],climate['Tmax'],climate['thetamin'],climate['thetamax'],times,inputs,params,climate['clay'],ivals,
+                                                 scheme=config.get('scheme','euler'),substeps=config.get('substeps',1),backend=config.get('backend','numpy'),
+                                                 sink=sink,disturbance=disturbance,model=model)
+    else:
+        raise ValueError('Unknown solver %s'%solver)
+    print('Wrote %s (%1.1f s)'%(output,time.time()-t0))
+    return store
+
+def main(argv=None):
+    import argparse
+    parser=argparse.ArgumentParser(prog='corpse',description='Run the CORPSE soil carbon model')
+    commands=parser.add_subparsers(dest='command')
+    run_parser=commands.add_parser('run',help='Run a simulation from a configuration file (YAML or JSON)')
+    run_parser.add_argument('config',help='Configuration file')
+    run_parser.add_argument('--output',help='Result store directory (overrides output in the configuration)')
+    args=parser.parse_args(argv)
+    if args.command=='run':
+        run(read_config(args.config),args.output)
+        return 0
+    parser.print_help()
+    return 1
+
+if __name__=='__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,166 @@
+# This file holds disturbance schedules: fires that the solvers apply as instantaneous transfers between pools at given times
+# Instead of chaining separate runs and editing initvals by hand after each fire (as in Whitman_sims.py), pass a FireSchedule to
+# run_models_ODE or run_models_iterator (disturbance=...). The solvers stop at each fire time, apply the transfers to every site that burns
+# at that time in one vectorized operation, and carry on from the changed state, so a run with many fires is still a single call.
+#
+# The fire's effects on soil temperature and moisture are handled separately, by CORPSE_forcing.FireForcing
+#
+# A schedule works on the (n_pools,npoints) state array with rows in the model's array_pools order (the rows after n_model_pools,
+# e.g. originalC, are not changed and can be left out)
+
+import CORPSE_array as CORPSE_deriv
+
+
+class FireSchedule(object):
+    '''Fires at each site, with the pool transfers that each fire causes
+       fire_times: Times of fires (years). Either a list of times at which every site burns, or an array of shape (nfires,npoints)
+                   with a column for each site (padded with NaN where a site has fewer fires), so sites can have different fire dates
+                   and return intervals (see return_interval_times)
+       severity: Multiplies all the fractions below, scalar or the same shape as fire_times (e.g. from 0 to 1 for burn severity of each fire)
+       combustion: Fraction of the unprotected C of each type that burns (added to CO2)
+       pyrogenic: Fraction of the unprotected C of each type that is left after combustion that is converted to pyrogenic C.
+                  The model does not have a separate pyrogenic pool, so it is added to the unprotected C of pyrogenic_type
+       protected_release: Fraction of the protected C of each type that is released to the unprotected pool (e.g. from aggregates broken up by heating)
+       microbe_kill: Fraction of living microbial biomass that is killed. Killed biomass becomes unprotected necromass
+       pyrogenic_type: C type (from the model's chem_types) that receives pyrogenic C
+       model: CORPSE_array.CORPSEModel of the simulations the schedule is used in (default is CORPSE_array.default_model)
+
+       combustion, pyrogenic and protected_release can be scalars or dictionaries keyed by the model's chem_types. Any fraction can also be an array
+       with one value per site. Transfers are applied in the order listed, so killed microbes and released protected C do not burn'''
+
+    def __init__(self,fire_times,severity=1.0,combustion=0.0,pyrogenic=0.0,protected_release=0.0,microbe_kill=0.0,pyrogenic_type='Slow',model=None):
+        from numpy import asarray,isfinite,argsort,unique,split,broadcast_to
+        if model is None:
+            model=CORPSE_deriv.default_model
+        self.model=model
+        if pyrogenic_type not in model.chem_types:
+            raise ValueError('Unknown pyrogenic C type %s'%pyrogenic_type)
+        self.pyrogenic_row=model.chem_types.index(pyrogenic_type)
+        fire_times=asarray(fire_times,dtype=float)
+        if fire_times.ndim<2:
+            fire_times=fire_times.reshape(-1,1)
+        severity=broadcast_to(asarray(severity,dtype=float),fire_times.shape)
+        self.npoints=fire_times.shape[1]
+
+        self.combustion=chem_fractions(combustion,'combustion',model)
+        self.pyrogenic=chem_fractions(pyrogenic,'pyrogenic',model)
+        self.protected_release=chem_fractions(protected_release,'protected_release',model)
+        self.microbe_kill=check_fraction(asarray(microbe_kill,dtype=float),'microbe_kill')
+        check_fraction(severity,'severity')
+
+        # Sort all fires by time and group the ones at the same time into one event, which is applied to all its sites together
+        fires,sites=isfinite(fire_times).nonzero()
+        order=argsort(fire_times[fires,sites],kind='stable')
+        fires,sites=fires[order],sites[order]
+        self.times,first=unique(fire_times[fires,sites],return_index=True)
+        self.sites=split(sites,first[1:])
+        self.severity=split(severity[fires,sites],first[1:])
+        self.time_list=list(self.times)
+        for n in range(len(self.times)):
+            if len(unique(self.sites[n]))<len(self.sites[n]):
+                raise ValueError('More than one fire at the same site at time %g'%self.times[n])
+            if self.npoints==1:
+                # Every site burns, so the event is applied to the whole state array rather than selected columns
+                self.sites[n]=None
+
+    def cache_key(self):
+        '''Description of the schedule for CORPSE_cache keys'''
+        return ['FireSchedule',self.times,self.sites,self.severity,self.combustion,self.pyrogenic,self.protected_release,self.microbe_kill,
+                self.pyrogenic_row,self.model]
+
+    def check_points(self,npoints,model=None):
+        '''Raise an error if the schedule or any of its fractions do not match the number of points or the model of a simulation'''
+        if model is not None and model.array_pools!=self.model.array_pools:
+            raise ValueError('Fire schedule is for model %r, but the simulation uses %r'%(self.model,model))
+        for name,value in [('combustion',self.combustion),('pyrogenic',self.pyrogenic),('protected_release',self.protected_release),
+                           ('microbe_kill',self.microbe_kill)]:
+            n=value.shape[-1] if value.ndim>0 else 1
+            if n!=1 and n!=npoints:
+                raise ValueError('Fire %s has %d values, but the simulation has %d points'%(name,n,npoints))
+        if self.npoints!=1 and self.npoints!=npoints:
+            raise ValueError('Fire schedule has %d sites, but the simulation has %d points'%(self.npoints,npoints))
+
+    def events_between(self,start,end):
+        '''Indices of the events (fire times) in start <= time < end'''
+        from bisect import bisect_left
+        return range(bisect_left(self.time_list,start),bisect_left(self.time_list,end))
+
+    def burned(self,event,npoints):
+        '''Boolean array of the points that burn in an event'''
+        from numpy import zeros,ones
+        if self.sites[event] is None:
+            return ones(npoints,dtype=bool)
+        mask=zeros(npoints,dtype=bool)
+        mask[self.sites[event]]=True
+        return mask
+
+    def apply(self,SOM,event):
+        '''Apply the pool transfers of one event (index into times) to the state array SOM in place. Only the sites that burn are changed'''
+        sites=self.sites[event]
+        if sites is None:
+            state=SOM
+        else:
+            state=SOM[:,sites]
+        s=self.severity[event]
+        def at_sites(value):
+            if sites is None or value.ndim==0 or value.shape[-1]==1:
+                return value*s
+            return value[...,sites]*s
+
+        model=self.model
+        u=state[model.u_rows]
+        p=state[model.p_rows]
+        burned=u*at_sites(self.combustion)
+        u-=burned
+        state[model.co2_row]+=burned.sum(axis=0)
+        pyrogenic=u*at_sites(self.pyrogenic)
+        u-=pyrogenic
+        u[self.pyrogenic_row]+=pyrogenic.sum(axis=0)
+        released=p*at_sites(self.protected_release)
+        p-=released
+        u+=released
+        killed=state[model.mic_row]*at_sites(self.microbe_kill)
+        state[model.mic_row]-=killed
+        state[model.necro_row]+=killed
+
+        if sites is not None:
+            SOM[:,sites]=state
+        return SOM
+
+
+# Fractions with a value for each C type, as an array with one row per C type (and a column per site if they differ between sites)
+def chem_fractions(value,name,model):
+    from numpy import asarray,broadcast,broadcast_to,array
+    if isinstance(value,dict):
+        values=[asarray(value[t],dtype=float) for t in model.chem_types]
+        shape=broadcast(*values).shape
+        value=array([broadcast_to(v,shape) for v in values])
+    else:
+        value=asarray(value,dtype=float)
+        value=broadcast_to(value,(model.nchem,)+value.shape)
+    if value.ndim==1:
+        value=value[:,None]
+    return check_fraction(value,name)
+
+def check_fraction(value,name):
+    if (value<0).any() or (value>1).any():
+        raise ValueError('Fire %s must be between 0 and 1'%name)
+    return value
+
+# Fire times for a fixed fire return interval at each site, for use as FireSchedule(fire_times)
+# interval: Years between fires, scalar or one value per site
+# end: No fires after this time
+# first: Time of the first fire, scalar or one value per site (default is one interval after time zero)
+# Returns an array of shape (nfires,npoints), padded with NaN for sites with fewer fires
+def return_interval_times(interval,end,first=None):
+    from numpy import asarray,arange,where,nan,isnan,atleast_1d,broadcast_arrays
+    interval=atleast_1d(asarray(interval,dtype=float))
+    if first is None:
+        first=interval
+    interval,first=broadcast_arrays(interval,atleast_1d(asarray(first,dtype=float)))
+    if (interval<=0).any():
+        raise ValueError('Fire return interval must be positive')
+    nfires=max(int((end-first.min())//interval.min())+1,0)
+    times=first[None,:]+arange(nfires)[:,None]*interval[None,:]
+    times=where(times<=end,times,nan)
+    return times[~isnan(times).all(axis=1)]
@@ -0,0 +1,325 @@
+# This file holds the temperature and soil moisture forcing used by the solvers
+# A forcing object gives temperature and moisture for every point at any model time, so the solvers can ask for it at whatever times they step to.
+#
+# All forcing objects have:
+#   npoints: Number of points (1 means the same forcing for every point)
+#   at(time): Returns (T,theta) at time (years), arrays with one value per point. T is in K and theta is fraction of saturation.
+#             The arrays are reused by the next call, so copy them to keep them
+#   constant: True if the forcing never changes with time
+#   periodic: True if the same values come back exactly during a run (e.g. a repeated year of records), so results calculated
+#             from them are worth caching
+#   key: After at(), a hashable value that is the same whenever at() returned the same values (e.g. the record index), or None
+#        if there is no such value. Solvers use it to look up Vmax (CompiledParams.vmax) in a time that does not depend on npoints
+#   cache_key(): Description of the forcing for CORPSE_cache keys, or None if results using it cannot be cached
+#
+# Temperatures given to the constructors are in degrees C, like the Tmin and Tmax arguments of the solvers
+
+
+class SinusoidalForcing(object):
+    '''Annual cosine cycle between minimum and maximum temperature and moisture, peaking at the start of each year.
+       This is the forcing that run_models_ODE and run_models_iterator have always used.
+       Tmin,Tmax: Temperature range (degrees C), scalars or one value per point
+       thetamin,thetamax: Moisture range (fraction of saturation), scalars or one value per point'''
+
+    def __init__(self,Tmin,Tmax,thetamin,thetamax):
+        from numpy import asarray,broadcast,zeros,empty,all
+        Tmin=asarray(Tmin,dtype=float)
+        Tmax=asarray(Tmax,dtype=float)
+        thetamin=asarray(thetamin,dtype=float)
+        thetamax=asarray(thetamax,dtype=float)
+        self.npoints=max(broadcast(Tmin,Tmax,thetamin,thetamax).size,1)
+        self.Tmin=zeros(self.npoints)+Tmin+273.15
+        self.Tamp=(zeros(self.npoints)+Tmax-Tmin)/2
+        self.thetamin=zeros(self.npoints)+thetamin
+        self.thetaamp=(zeros(self.npoints)+thetamax-thetamin)/2
+        self.constant=bool(all(self.Tamp==0) and all(self.thetaamp==0))
+        # The cycle is evaluated at arbitrary times, so values almost never repeat exactly unless they are constant
+        self.periodic=False
+        self.key=0 if self.constant else None
+        self.T=empty(self.npoints)
+        self.theta=empty(self.npoints)
+
+    def at(self,time):
+        from numpy import cos,pi,multiply,add
+        c=cos(time*2*pi)+1
+        multiply(self.Tamp,c,out=self.T)
+        add(self.T,self.Tmin,out=self.T)
+        multiply(self.thetaamp,c,out=self.theta)
+        add(self.theta,self.thetamin,out=self.theta)
+        return self.T,self.theta
+
+    def cache_key(self):
+        return ['SinusoidalForcing',self.Tmin,self.Tamp,self.thetamin,self.thetaamp]
+
+
+class GriddedForcing(object):
+    '''Forcing from arrays of temperature and moisture at a series of times (e.g. daily station records or gridded climate data)
+       times: Times of the records (years), increasing
+       T: Temperature (degrees C), shape (len(times),npoints), or (len(times),) for the same series at every point
+       theta: Moisture (fraction of saturation), same shapes as T
+       method: 'linear' interpolates between records, 'previous' holds each record until the next one
+       period: If given, times are wrapped into one period (e.g. period=1.0 to repeat one year of daily climatology). With linear
+               interpolation, times after the last record are interpolated towards the first record of the next period
+
+       T and theta can be memory-mapped arrays (numpy.load(...,mmap_mode='r')), in which case only the records that are used are read.
+       Looking up a time is O(1) for evenly spaced records, and O(1) on average for unevenly spaced records when times are requested in order'''
+
+    def __init__(self,times,T,theta,method='linear',period=None):
+        from numpy import asarray,empty,diff,allclose
+        if method not in ['linear','previous']:
+            raise ValueError('Unknown interpolation method %s'%method)
+        self.times=asarray(times,dtype=float)
+        self.T_records=T
+        self.theta_records=theta
+        if len(T)!=len(self.times) or len(theta)!=len(self.times):
+            raise ValueError('T and theta must have one record for each time')
+        self.method=method
+        self.period=period
+        self.npoints=1 if T.ndim==1 else T.shape[1]
+        self.constant=False
+        self.periodic=period is not None
+        self.key=None
+        steps=diff(self.times)
+        if (steps<=0).any():
+            raise ValueError('Forcing times must be increasing')
+        self.uniform=len(steps)>0 and allclose(steps,steps[0],rtol=1e-9,atol=0)
+        self.dt=steps[0] if len(steps)>0 else 1.0
+        self.last_index=0
+        self.T=empty(self.npoints)
+        self.theta=empty(self.npoints)
+        self.tmp=empty(self.npoints)
+
+    def index(self,time):
+        '''Index of the last record at or before time (clamped to the records)'''
+        from numpy import searchsorted
+        n=len(self.times)
+        if self.uniform:
+            i=int((time-self.times[0])/self.dt+1e-9)
+        else:
+            i=self.last_index
+            # Requests are usually in order, so look near the previous index before searching the whole series
+            if self.times[i]<=time and (i+1>=n or time<self.times[i+1]):
+                pass
+            elif i+2<n and self.times[i+1]<=time<self.times[i+2]:
+                i=i+1
+            else:
+                i=searchsorted(self.times,time,side='right')-1
+        i=min(max(i,0),n-1)
+        self.last_index=i
+        return i
+
+    def at(self,time):
+        from numpy import subtract,multiply,add,copyto
+        if self.period is not None:
+            time=self.times[0]+(time-self.times[0])%self.period
+        i=self.index(time)
+        w=0.0
+        # Record after i and its time. With a period, the last record is followed by the first one in the next period
+        n=len(self.times)
+        if i<n-1:
+            j,next_time=i+1,self.times[i+1]
+        elif self.period is not None:
+            j,next_time=0,self.times[0]+self.period
+        else:
+            j,next_time=i,None
+        if self.method!='previous' and next_time is not None and time>self.times[0]:
+            w=(time-self.times[i])/(next_time-self.times[i])
+            # Times within rounding error of a record use the record itself, so steps that land on records repeat exactly
+            if w>1-1e-9:
+                i,w=j,0.0
+            elif w<1e-9:
+                w=0.0
+        if w==0.0:
+            copyto(self.T,self.T_records[i])
+            copyto(self.theta,self.theta_records[i])
+            self.key=i
+        else:
+            self.key=(i,w)
+            for records,out in [(self.T_records,self.T),(self.theta_records,self.theta)]:
+                subtract(records[j],records[i],out=self.tmp)
+                multiply(self.tmp,w,out=self.tmp)
+                add(self.tmp,records[i],out=out)
+        self.T+=273.15
+        return self.T,self.theta
+
+    def cache_key(self):
+        return ['GriddedForcing',self.times,self.T_records,self.theta_records,self.method,self.period]
+
+
+class StreamingForcing(object):
+    '''Forcing that is read a block at a time from a generator, so long records never have to be held in memory in full
+       blocks: Iterable yielding (times,T,theta) blocks in time order, with the same layout as GriddedForcing (T in degrees C)
+       method: 'linear' or 'previous', as in GriddedForcing
+
+       Times must be requested in (roughly) increasing order. Only the current block and the one before it are kept, so going back
+       further than that raises an error. This leaves room for ODE solvers that step back after a rejected step, as long as blocks
+       are longer than the solver's steps'''
+
+    def __init__(self,blocks,method='linear'):
+        self.blocks=iter(blocks)
+        self.method=method
+        self.window=None
+        self.finished=False
+        self.next_block()
+        self.npoints=self.window.npoints
+        self.constant=False
+        self.periodic=False
+        self.key=None
+
+    def next_block(self):
+        from numpy import asarray,concatenate
+        try:
+            times,T,theta=next(self.blocks)
+        except StopIteration:
+            self.finished=True
+            return False
+        times=asarray(times,dtype=float)
+        T=asarray(T,dtype=float)
+        theta=asarray(theta,dtype=float)
+        if self.window is not None:
+            # Keep the previous block so times between blocks can be interpolated and solvers can step back
+            previous=self.block_start
+            times=concatenate([self.window.times[previous:],times])
+            T=concatenate([self.window.T_records[previous:],T])
+            theta=concatenate([self.window.theta_records[previous:],theta])
+            self.block_start=len(self.window.times)-previous
+        else:
+            self.block_start=0
+        self.window=GriddedForcing(times,T,theta,method=self.method)
+        return True
+
+    def at(self,time):
+        while time>self.window.times[-1] and not self.finished:
+            self.next_block()
+        if time<self.window.times[0] and len(self.window.times)>1:
+            raise ValueError('Time %g is before the forcing block that is currently loaded (starts at %g)'%(time,self.window.times[0]))
+        return self.window.at(time)
+
+    def cache_key(self):
+        # The records are only known once they have been read
+        return None
+
+
+class CallbackForcing(object):
+    '''Forcing from a function, for forcing that is calculated rather than read (e.g. from another model)
+       function: Called as function(time), returns (T,theta) with T in degrees C, each a scalar or one value per point
+       npoints: Number of points the function returns values for'''
+
+    def __init__(self,function,npoints=1):
+        from numpy import empty
+        self.function=function
+        self.npoints=npoints
+        self.constant=False
+        self.periodic=False
+        self.key=None
+        self.T=empty(npoints)
+        self.theta=empty(npoints)
+
+    def at(self,time):
+        T,theta=self.function(time)
+        self.T[:]=T
+        self.T+=273.15
+        self.theta[:]=theta
+        return self.T,self.theta
+
+    def cache_key(self):
+        # Results depend on what the function does, which cannot be checked
+        return None
+
+
+class FireForcing(object):
+    '''Post-fire changes added on top of another forcing: a soil heating pulse and soil drying that both decay exponentially after the fire
+       base: The forcing without fire
+       fire_time: Time of the fire (years), scalar or one value per point (NaN for points that do not burn)
+       heating: Temperature increase right after the fire (degrees C), scalar or one value per point (e.g. scaled by burn severity)
+       heating_time: e-folding time of the heating pulse (years)
+       drying: Fraction by which soil moisture is reduced right after the fire, scalar or one value per point
+       drying_time: e-folding time of the drying (years)'''
+
+    def __init__(self,base,fire_time,heating=0.0,heating_time=0.05,drying=0.0,drying_time=0.5):
+        from numpy import asarray,zeros,empty,broadcast
+        self.base=base
+        self.npoints=max(base.npoints,broadcast(asarray(fire_time),asarray(heating),asarray(drying)).size)
+        self.fire_time=zeros(self.npoints)+asarray(fire_time,dtype=float)
+        self.heating=zeros(self.npoints)+asarray(heating,dtype=float)
+        self.drying=zeros(self.npoints)+asarray(drying,dtype=float)
+        self.heating_time=heating_time
+        self.drying_time=drying_time
+        self.constant=False
+        self.periodic=False
+        self.key=None
+        self.T=empty(self.npoints)
+        self.theta=empty(self.npoints)
+        self.since=empty(self.npoints)
+        self.tmp=empty(self.npoints)
+
+    def at(self,time):
+        from numpy import subtract,exp,divide,multiply,add,where,errstate
+        T,theta=self.base.at(time)
+        subtract(time,self.fire_time,out=self.since)
+        # Before the fire (or with no fire) the effect is zero
+        with errstate(invalid='ignore'):
+            self.since[~(self.since>=0)]=float('inf')
+        divide(self.since,-self.heating_time,out=self.tmp)
+        exp(self.tmp,out=self.tmp)
+        multiply(self.tmp,self.heating,out=self.tmp)
+        add(T,self.tmp,out=self.T)
+        divide(self.since,-self.drying_time,out=self.tmp)
+        exp(self.tmp,out=self.tmp)
+        multiply(self.tmp,self.drying,out=self.tmp)
+        subtract(1.0,self.tmp,out=self.tmp)
+        multiply(theta,self.tmp,out=self.theta)
+        return self.T,self.theta
+
+    def cache_key(self):
+        base=self.base.cache_key()
+        if base is None:
+            return None
+        return ['FireForcing',base,self.fire_time,self.heating,self.heating_time,self.drying,self.drying_time]
+
+
+# Read forcing from a table (CSV or Parquet) with a time column and columns of temperature (degrees C) and moisture
+# T_columns and theta_columns are lists of column names, one per point (or a single column used for every point)
+# If chunksize is given, the file is read that many rows at a time as the solver needs them (StreamingForcing).
+# Otherwise it is read all at once (GriddedForcing)
+def read_forcing(path,T_columns,theta_columns,time_column='time',method='linear',chunksize=None,period=None):
+    if isinstance(T_columns,str):
+        T_columns=[T_columns]
+    if isinstance(theta_columns,str):
+        theta_columns=[theta_columns]
+    columns=[time_column]+list(T_columns)+list(theta_columns)
+
+    def split(table):
+        return table[time_column].values,table[T_columns].values,table[theta_columns].values
+
+    if chunksize is None:
+        times,T,theta=split(read_table(path,columns))
+        return GriddedForcing(times,T,theta,method=method,period=period)
+    else:
+        if period is not None:
+            raise ValueError('Periodic forcing cannot be streamed')
+        return StreamingForcing((split(block) for block in read_table_chunks(path,columns,chunksize)),method=method)
+
+def read_table(path,columns):
+    import pandas
+    if str(path).endswith('.parquet'):
+        return pandas.read_parquet(path,columns=columns)
+    else:
+        return pandas.read_csv(path,usecols=columns)
+
+def read_table_chunks(path,columns,chunksize):
+    import pandas
+    if str(path).endswith('.parquet'):
+        # pyarrow can read Parquet files in batches. Without it, the whole file is read and then split
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            table=pandas.read_parquet(path,columns=columns)
+            for start in range(0,len(table),chunksize):
+                yield table.iloc[start:start+chunksize]
+            return
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize,columns=columns):
+            yield batch.to_pandas()
+    else:
+        for block in pandas.read_csv(path,usecols=columns,chunksize=chunksize):
+            yield block
@@ -0,0 +1,133 @@
+# This file holds compiled versions of the CORPSE rate calculation and the explicit time steps, for vector_iterate(...,backend='numba')
+# The numpy version (CORPSE_deriv_array) works on whole arrays one operation at a time, so every rate calculation goes through the state
+# many times and needs scratch arrays. These kernels instead loop over points and do the whole calculation for one point at a time,
+# including the time step update, and the loop over points is run in parallel.
+#
+# They are compiled with numba if it is installed. Without numba, available is False and the solvers use the numpy version instead.
+# The functions still run as plain python (which is useful for checking them on a few points), but are far too slow for real runs.
+#
+# Temperature and moisture are constant over a time step, so Vmax (from CompiledParams.vmax, which caches it) and the moisture
+# function (moisture_array) are calculated with numpy once per step and passed to the kernels, rather than for every stage.
+# The calculation is otherwise the same as CORPSE_deriv_array, so results match it to rounding error
+
+import CORPSE_array as CORPSE_deriv
+
+try:
+    from numba import njit,prange
+    available=True
+except ImportError:
+    available=False
+    prange=range
+    def njit(*args,**kwargs):
+        # Used as @njit(...) so return a decorator that leaves the function unchanged
+        return lambda f: f
+
+# Layout of the state array of a CORPSEModel, passed to the kernels as plain integers
+def kernel_layout(model):
+    return (model.nchem,model.u_rows.start,model.p_rows.start,model.mic_row,model.co2_row,model.necro_row,model.n_model_pools)
+
+layout=kernel_layout(CORPSE_deriv.default_model)
+
+# Parameters for the kernels, from a CompiledParams. Each parameter is an array with one value per point (with one row per C type
+# for parameters that have a value for each C type). Scalar parameters are broadcast (zero stride) rather than copied out to every point.
+# The clay modifier is included in the protection rate. Returns a tuple in the order expected by the kernels
+def kernel_params(compiled,npoints):
+    from numpy import broadcast_to,asarray
+    nchem=compiled.model.nchem
+    p=compiled.arrays
+    def per_point(value):
+        return broadcast_to(asarray(value,dtype=float),(npoints,))
+    def per_chem(value):
+        return broadcast_to(asarray(value,dtype=float),(nchem,npoints))
+    return (per_chem(p['kC']),per_chem(p['eup']),per_chem(p['protection_rate']*compiled.claymod),
+            per_point(p['minMicrobeC']),per_point(p['Tmic']),per_point(p['et']),per_point(p['tProtected']))
+
+# Inputs for the kernels from the (n_pools,npoints) input rates, as a zero-stride view if they are the same at every point
+def kernel_inputs(input_rates):
+    from numpy import broadcast_to
+    if (input_rates==input_rates[:,:1]).all():
+        return broadcast_to(input_rates[:,:1],input_rates.shape)
+    return input_rates
+
+# Moisture function (normalized by its maximum) at every point, written into out. Uses numpy, which is faster than a compiled loop
+# for the power functions, and is only needed once per time step
+def moisture_array(theta,params,amax,out):
+    from numpy import clip,power,subtract,multiply,divide
+    theta=clip(theta,0.0,1.0,out=out)
+    tmp=subtract(1.0,theta)
+    power(tmp,params['gas_diffusion_exp'],out=tmp)
+    power(theta,params['substrate_diffusion_exp'],out=out)
+    multiply(out,tmp,out=out)
+    divide(out,amax,out=out)
+    return out
+
+# Rates of change of all pools at point j of Y (plus inputs), written into column j of out
+@njit(cache=True,inline='always')
+def point_rates(Y,j,moisture,vmax,kC,eup,prot,minMicrobeC,Tmic,et,tProtected,inputs,layout,out):
+    nchem,u0,p0,mic_row,co2_row,necro_row,nmodel=layout
+
+    mic=Y[mic_row,j]
+    sumU=0.0
+    for c in range(nchem):
+        sumU+=Y[u0+c,j]
+    # Skip the decomposition calculation if there is no carbon, moisture or microbial biomass (to avoid dividing by zero)
+    dodecomp=sumU!=0.0 and moisture!=0.0 and mic!=0.0
+    turnover=max((mic-sumU*minMicrobeC[j])/Tmic[j],0.0)
+
+    growth=0.0
+    total=0.0
+    for c in range(nchem):
+        if dodecomp:
+            decomp=Y[u0+c,j]*mic*moisture*vmax[c,j]/(kC[c,j]*sumU+mic)
+        else:
+            decomp=0.0
+        growth+=decomp*eup[c,j]
+        total+=decomp
+        dp=Y[u0+c,j]*prot[c,j]-Y[p0+c,j]/tProtected[j]
+        out[p0+c,j]=dp+inputs[p0+c,j]
+        out[u0+c,j]=-decomp-dp+inputs[u0+c,j]
+    out[mic_row,j]=growth-turnover+inputs[mic_row,j]
+    out[co2_row,j]=total-growth+turnover-turnover*et[j]+inputs[co2_row,j]
+    out[necro_row,j]+=turnover*et[j]
+    for i in range(nmodel,Y.shape[0]):
+        out[i,j]=0.0
+
+# Rates of change at every point, the same as CORPSE_deriv_array plus inputs
+# vmax is from CompiledParams.vmax broadcast to (n C types,npoints), moisture is from moisture_array
+@njit(parallel=True,cache=True)
+def rates(SOM,vmax,moisture,inputs,kp,layout,out):
+    kC,eup,prot,minMicrobeC,Tmic,et,tProtected=kp
+    for j in prange(SOM.shape[1]):
+        point_rates(SOM,j,moisture[j],vmax,kC,eup,prot,minMicrobeC,Tmic,et,tProtected,inputs,layout,out)
+    return out
+
+# One forward Euler step, updating SOM in place. k is a scratch array the same shape as SOM
+@njit(parallel=True,cache=True)
+def euler_step(SOM,dt,vmax,moisture,inputs,kp,layout,k):
+    kC,eup,prot,minMicrobeC,Tmic,et,tProtected=kp
+    npools=SOM.shape[0]
+    for j in prange(SOM.shape[1]):
+        point_rates(SOM,j,moisture[j],vmax,kC,eup,prot,minMicrobeC,Tmic,et,tProtected,inputs,layout,k)
+        for i in range(npools):
+            SOM[i,j]+=dt*k[i,j]
+
+# nsub fourth order Runge-Kutta steps over an interval dt, updating SOM in place. k1-k4 and Y are scratch arrays the same shape as SOM
+@njit(parallel=True,cache=True)
+def rk4_step(SOM,dt,nsub,vmax,moisture,inputs,kp,layout,k1,k2,k3,k4,Y):
+    kC,eup,prot,minMicrobeC,Tmic,et,tProtected=kp
+    npools=SOM.shape[0]
+    h=dt/nsub
+    for j in prange(SOM.shape[1]):
+        for n in range(nsub):
+            point_rates(SOM,j,moisture[j],vmax,kC,eup,prot,minMicrobeC,Tmic,et,tProtected,inputs,layout,k1)
+            for i in range(npools):
+                Y[i,j]=SOM[i,j]+0.5*h*k1[i,j]
+            point_rates(Y,j,moisture[j],vmax,kC,eup,prot,minMicrobeC,Tmic,et,tProtected,inputs,layout,k2)
+            for i in range(npools):
+                Y[i,j]=SOM[i,j]+0.5*h*k2[i,j]
+            point_rates(Y,j,moisture[j],vmax,kC,eup,prot,minMicrobeC,Tmic,et,tProtected,inputs,layout,k3)
+            for i in range(npools):
+                Y[i,j]=SOM[i,j]+h*k3[i,j]
+            point_rates(Y,j,moisture[j],vmax,kC,eup,prot,minMicrobeC,Tmic,et,tProtected,inputs,layout,k4)
+            for i in range(npools):
+                SOM[i,j]+=h/6.0*(k1[i,j]+2.0*k2[i,j]+2.0*k3[i,j]+k4[i,j])
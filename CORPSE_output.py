@@ -0,0 +1,313 @@
+# This file holds output sinks for the explicit iterator (CORPSE_solvers.vector_iterate)
+# A sink receives the model state at every time step and decides what to keep, so memory use can be limited to what is needed
+# instead of storing every pool at every step for every point.
+#
+# Each sink has three methods that the iterator calls:
+#   start(fields,rows,npoints,times): Called once before the first step. fields are the names of the pools to output,
+#                                     rows are the corresponding rows in the state array, times are all the model time steps
+#   record(step,time,SOM): Called after every step with the (n_pools,npoints) state array. SOM is reused by the iterator, so sinks must copy what they keep
+#   initial(SOM): Optional. If a sink has it, it is called after start with the initial state, before the first step
+#   finish(): Called once at the end. Its return value is returned by vector_iterate
+
+
+class FullOutput(object):
+    '''Keep every pool at every time step. Result is a dictionary of arrays with shape (npoints,len(times)). This is the default'''
+
+    def start(self,fields,rows,npoints,times):
+        from numpy import zeros
+        self.fields=fields
+        self.rows=rows
+        self.times=times
+        self.SOM_out=dict([(field,zeros((npoints,len(times)))) for field in fields])
+
+    def record(self,step,time,SOM):
+        for field,row in zip(self.fields,self.rows):
+            self.SOM_out[field][:,step]=SOM[row]
+
+    def finish(self):
+        return self.SOM_out
+
+
+class DecimatedOutput(FullOutput):
+    '''Keep every Nth time step (starting with the first). Result is a dictionary of arrays with shape (npoints,number of kept steps)
+       The times of the kept steps are in the times attribute after the run'''
+
+    def __init__(self,every):
+        self.every=every
+
+    def start(self,fields,rows,npoints,times):
+        FullOutput.start(self,fields,rows,npoints,times[::self.every])
+
+    def record(self,step,time,SOM):
+        if step%self.every==0:
+            FullOutput.record(self,step//self.every,time,SOM)
+
+
+class AggregateOutput(object):
+    '''Keep running aggregates of each pool over fixed periods (e.g. annual). Memory use is one value per point per period
+       period: Length of each aggregation period, in the same units as times (years)
+       how: How to aggregate: 'mean', 'sum', 'last' (value at the end of the period), or 'delta' (change over the period,
+            e.g. total CO2 respired during the period from the cumulative CO2 pool).
+            Either one for all pools, or a dictionary of pool name: how
+       fields: Pools to aggregate (default is all pools)
+
+       Result is a dictionary of arrays with shape (npoints,number of periods). The start time of each period is in the times attribute after the run'''
+
+    def __init__(self,period=1.0,how='mean',fields=None):
+        self.period=period
+        self.how=how
+        self.keep_fields=fields
+
+    def start(self,fields,rows,npoints,times):
+        from numpy import zeros,floor,unique
+        if self.keep_fields is not None:
+            rows=[rows[fields.index(f)] for f in self.keep_fields]
+            fields=list(self.keep_fields)
+        self.fields=fields
+        self.rows=rows
+        if isinstance(self.how,dict):
+            self.hows=[self.how.get(f,'mean') for f in fields]
+        else:
+            self.hows=[self.how for f in fields]
+        for how in self.hows:
+            if how not in ['mean','sum','last','delta']:
+                raise ValueError('Unknown aggregation %s'%how)
+        # Period that each time step belongs to
+        self.period_of_step=floor((times-times[0])/self.period+1e-9).astype(int)
+        self.times=times[0]+unique(self.period_of_step)*self.period
+        nperiods=self.period_of_step[-1]+1
+        self.SOM_out=dict([(f,zeros((npoints,nperiods))) for f in fields])
+        # Value at the end of the previous period, for delta. The first period's change is from the initial state. If the iterator
+        # does not give the initial state, it is from the first step
+        self.previous=zeros((len(fields),npoints))
+        self.have_initial=False
+        self.count=0
+
+    def initial(self,SOM):
+        for n,row in enumerate(self.rows):
+            self.previous[n]=SOM[row]
+        self.have_initial=True
+
+    def record(self,step,time,SOM):
+        period=self.period_of_step[step]
+        if step==0:
+            if not self.have_initial:
+                self.initial(SOM)
+        elif period!=self.period_of_step[step-1]:
+            self.close_period(self.period_of_step[step-1])
+        self.count+=1
+        for n,(field,row,how) in enumerate(zip(self.fields,self.rows,self.hows)):
+            out=self.SOM_out[field][:,period]
+            if how in ['mean','sum']:
+                out+=SOM[row]
+            else:
+                out[:]=SOM[row]
+
+    def close_period(self,period):
+        for n,(field,row,how) in enumerate(zip(self.fields,self.rows,self.hows)):
+            out=self.SOM_out[field][:,period]
+            if how=='mean':
+                out/=self.count
+            elif how=='delta':
+                last=out.copy()
+                out-=self.previous[n]
+                self.previous[n]=last
+        self.count=0
+
+    def finish(self):
+        self.close_period(self.period_of_step[-1])
+        return self.SOM_out
+
+
+class CallbackOutput(object):
+    '''Collect chunks of time steps and pass each one to a function, so output can be streamed (e.g. written to disk) as the model runs.
+       Memory use is one chunk.
+       callback: Function called as callback(times,data) where times are the times of the steps in the chunk and
+                 data is a dictionary of pool name: array of shape (npoints,steps in chunk)
+       chunk: Number of time steps per chunk. The last chunk can be shorter
+       copy: If False, the same arrays are reused for every chunk, so the callback must copy anything it keeps
+
+       finish() returns None'''
+
+    def __init__(self,callback,chunk=100,copy=True):
+        self.callback=callback
+        self.chunk=chunk
+        self.copy=copy
+
+    def start(self,fields,rows,npoints,times):
+        from numpy import zeros
+        self.fields=fields
+        self.rows=rows
+        self.times=times
+        self.buffer=dict([(f,zeros((npoints,self.chunk))) for f in fields])
+        self.first_step=0
+        self.nbuffered=0
+
+    def record(self,step,time,SOM):
+        if self.nbuffered==0:
+            self.first_step=step
+        for field,row in zip(self.fields,self.rows):
+            self.buffer[field][:,self.nbuffered]=SOM[row]
+        self.nbuffered+=1
+        if self.nbuffered==self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.nbuffered==0:
+            return
+        n=self.nbuffered
+        if self.copy:
+            data=dict([(f,self.buffer[f][:,:n].copy()) for f in self.fields])
+        else:
+            data=dict([(f,self.buffer[f][:,:n]) for f in self.fields])
+        self.nbuffered=0
+        self.callback(self.times[self.first_step:self.first_step+n],data)
+
+    def finish(self):
+        self.flush()
+        return None
+
+
+# On-disk results
+# A result store is a directory holding:
+#   data.npy:   All output in one array of shape (n_pools,n_sites,n_times), so one pool or one site can be read as a memory-mapped slice without copying
+#   times.npy:  Model times of the output
+#   sites.json: Site IDs
+#   meta.json:  Pool names, array shape, and how many time steps have been written so far (so a partly written store can be read as a checkpoint)
+
+class StoreOutput(object):
+    '''Write output directly to a result store on disk as the model runs. Time steps are collected in memory in chunks
+       and written to the memory-mapped array one chunk at a time, so memory use is one chunk.
+       path: Directory for the store (created if needed, existing store files are overwritten)
+       site_ids: IDs of the points (default is 0,1,2,...)
+       chunk: Number of time steps per chunk
+
+       finish() returns the ResultStore'''
+
+    def __init__(self,path,site_ids=None,chunk=100):
+        self.path=path
+        self.site_ids=site_ids
+        self.chunk=chunk
+
+    def start(self,fields,rows,npoints,times):
+        from numpy import zeros
+        self.fields=fields
+        self.rows=rows
+        self.data=create_store(self.path,fields,times,self.site_ids,npoints)
+        self.buffer=zeros((len(fields),npoints,self.chunk))
+        self.first_step=0
+        self.nbuffered=0
+
+    def record(self,step,time,SOM):
+        if self.nbuffered==0:
+            self.first_step=step
+        self.buffer[:,:,self.nbuffered]=SOM[self.rows]
+        self.nbuffered+=1
+        if self.nbuffered==self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.nbuffered==0:
+            return
+        n=self.nbuffered
+        self.data[:,:,self.first_step:self.first_step+n]=self.buffer[:,:,:n]
+        self.data.flush()
+        write_meta(self.path,self.fields,self.data.shape,self.first_step+n)
+        self.nbuffered=0
+
+    def finish(self):
+        self.flush()
+        del self.data
+        return ResultStore(self.path)
+
+# Create the files for a result store and return the (n_pools,n_sites,n_times) memory-mapped data array to fill in
+def create_store(path,fields,times,site_ids,nsites):
+    import os,json
+    from numpy import asarray,save
+    from numpy.lib.format import open_memmap
+    os.makedirs(path,exist_ok=True)
+    times=asarray(times,dtype=float)
+    if site_ids is None:
+        site_ids=list(range(nsites))
+    site_ids=[s.item() if hasattr(s,'item') else s for s in site_ids]
+    if len(site_ids)!=nsites:
+        raise ValueError('Got %d site IDs for %d sites'%(len(site_ids),nsites))
+    save(os.path.join(path,'times.npy'),times)
+    with open(os.path.join(path,'sites.json'),'w') as f:
+        json.dump(site_ids,f)
+    data=open_memmap(os.path.join(path,'data.npy'),mode='w+',dtype='float64',shape=(len(fields),nsites,len(times)))
+    write_meta(path,fields,data.shape,0)
+    return data
+
+def write_meta(path,fields,shape,nwritten):
+    import os,json
+    # Write to a temporary file and rename, so readers never see a partly written metadata file
+    fname=os.path.join(path,'meta.json')
+    with open(fname+'.tmp','w') as f:
+        json.dump({'fields':list(fields),'shape':list(shape),'nwritten':int(nwritten)},f)
+    os.replace(fname+'.tmp',fname)
+
+# Write simulation results to a result store
+# results is either a list of DataFrames with one per site (output of run_models_ODE or run_models_iterator),
+# or a dictionary of pool name: array of shape (n_sites,n_times) (output of vector_iterate)
+# times is required for the dictionary form. Returns the ResultStore
+def write_results(path,results,site_ids=None,times=None):
+    from numpy import asarray
+    if isinstance(results,dict):
+        fields=list(results.keys())
+        nsites=asarray(results[fields[0]]).shape[0]
+        data=create_store(path,fields,times,site_ids,nsites)
+        for n,f in enumerate(fields):
+            data[n]=results[f]
+    else:
+        fields=list(results[0].columns)
+        if times is None:
+            times=asarray(results[0].index,dtype=float)
+        data=create_store(path,fields,times,site_ids,len(results))
+        for site,df in enumerate(results):
+            data[:,site,:]=df[fields].values.T
+    data.flush()
+    write_meta(path,fields,data.shape,data.shape[2])
+    del data
+    return ResultStore(path)
+
+class ResultStore(object):
+    '''Read access to a result store. Nothing is read from disk until it is used: pool() and site() return memory-mapped views
+       path: Store directory
+
+       Attributes: fields (pool names), times, site_ids, nwritten (number of time steps written so far)'''
+
+    def __init__(self,path):
+        import os,json
+        from numpy import load
+        self.path=path
+        with open(os.path.join(path,'meta.json')) as f:
+            meta=json.load(f)
+        with open(os.path.join(path,'sites.json')) as f:
+            self.site_ids=json.load(f)
+        self.fields=meta['fields']
+        self.nwritten=meta['nwritten']
+        self.data=load(os.path.join(path,'data.npy'),mmap_mode='r')[:,:,:self.nwritten]
+        self.times=load(os.path.join(path,'times.npy'),mmap_mode='r')[:self.nwritten]
+
+    def site_index(self,site):
+        '''Position of a site, given its ID'''
+        return self.site_ids.index(site)
+
+    def pool(self,name):
+        '''All sites and times for one pool, shape (n_sites,n_times)'''
+        return self.data[self.fields.index(name)]
+
+    def site(self,index):
+        '''All pools and times for the site at position index, shape (n_pools,n_times). Use site_index to look up a site ID'''
+        return self.data[:,index,:]
+
+    def site_dataframe(self,index):
+        '''One site as a DataFrame, the same as one item of the output of run_models_ODE. The values are a read-only view of the
+           memory-mapped store, so they are only read from disk when used'''
+        import pandas
+        return pandas.DataFrame(self.site(index).T,columns=self.fields,index=self.times,copy=False)
+
+    def to_dataframes(self):
+        '''All sites as a list of DataFrames, the same as the output of run_models_ODE'''
+        return [self.site_dataframe(n) for n in range(self.data.shape[1])]
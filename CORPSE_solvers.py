@@ -1,34 +1,41 @@
 import CORPSE_array as CORPSE_deriv
+import CORPSE_stats
 import numpy
-fields = CORPSE_deriv.expected_pools
-fields.remove('originalC')
+# Pools that the solvers work with and output, for the default model. Solvers given another model (model=...) use model.fields
+fields = CORPSE_deriv.default_model.fields
+
+# The model for a run: the one the parameters were compiled for if they are a CompiledParams, otherwise model or the default model
+def get_model(model,params=None):
+    if isinstance(params,CORPSE_deriv.CompiledParams):
+        if model is not None and model is not params.model:
+            raise ValueError('Parameters were compiled for a different model')
+        return params.model
+    if model is None:
+        return CORPSE_deriv.default_model
+    return model
 
 # This is a function that translates the CORPSE model pools to/from the format that the equation solver expects
-# The solver will call it multiple times and passes it a list of parameters that needs to be converted to a named "dictionary" that CORPSE expects
-def fsolve_wrapper(SOM_list,T,theta,inputs,clay,params):
-    from numpy import atleast_1d,concatenate
+# The solver will call it multiple times and passes it a list of pool values in the order of the model's fields, which are the first rows of the state array
+# params is a CompiledParams (the model is the one it was compiled for) or a parameter dictionary for the default model
+# clay is only used with a parameter dictionary. A CompiledParams carries the clay modifier it was compiled with, so it is not recalculated at every call
+# stats is a CORPSE_stats.SolverStats that the time spent in the model itself is added to (as stage 'deriv')
+def fsolve_wrapper(SOM_list,T,theta,inputs,clay,params,stats=CORPSE_stats.no_stats):
+    from numpy import asarray
 
-    # Make an empty dictionary and fill it with the right values
-    # Values are in the correct order because we use the same "fields" list of pools
-    SOM_dict={}
-    for n in range(len(fields)):
-        SOM_dict[fields[n]]=atleast_1d(SOM_list[n])
+    model=get_model(None,params)
+    if not isinstance(params,CORPSE_deriv.CompiledParams):
+        params=model.compile(params,clay=clay,cache_vmax=False)
+    SOM=asarray(SOM_list,dtype=float)
 
     # Call the CORPSE model function that returns the derivative (with time) of each pool
-    deriv=CORPSE_deriv.CORPSE_deriv(SOM_dict,atleast_1d([T]),atleast_1d([theta]),params,claymod=CORPSE_deriv.prot_clay(clay)/CORPSE_deriv.prot_clay(20))
+    with stats.timer('deriv'):
+        deriv=CORPSE_deriv.CORPSE_deriv_array(SOM,T,theta,params,claymod=params.claymod,model=model)
 
     # Since we have carbon inputs, these also need to be added to those rates of change with time
     for pool in inputs.keys():
-        deriv[pool]+=inputs[pool]
-
-
-    # Put the CORPSE pools back into a list that the equation solver can deal with
-    vals=list(concatenate([deriv[f] for f in fields]))
+        deriv[model.pool_index[pool]]+=inputs[pool]
 
-    if len(SOM_list)==len(fields)*2:
-        vals=vals+vals_Ohorizon
-
-    return vals
+    return deriv
 
 # The ordinary differential equation (ODE) integrating function also wants to send the current time to the function it's integrating
 # Our model doesn't have an explicit dependence on time, but we need a separate function that can deal with the extra argument.
@@ -39,58 +46,406 @@ def ode_wrapper(SOM_list,time,Tmax,Tmin,thetamax,thetamin,*args,**kwargs):
     theta=(cos(time*2*pi)+1)*(thetamax-thetamin)/2+thetamin
     return fsolve_wrapper(SOM_list,T,theta,*args,**kwargs)
 
+# Jacobian matching ode_wrapper, in the form odeint expects for its Dfun argument (same arguments as ode_wrapper)
+def ode_jacobian(SOM_list,time,Tmax,Tmin,thetamax,thetamin,inputs,clay,params,stats=None):
+    from numpy import cos,pi,asarray
+    T=(cos(time*2*pi)+1)*(Tmax-Tmin)/2+Tmin
+    theta=(cos(time*2*pi)+1)*(thetamax-thetamin)/2+thetamin
+    model=get_model(None,params)
+    if not isinstance(params,CORPSE_deriv.CompiledParams):
+        params=model.compile(params,clay=clay,cache_vmax=False)
+    return CORPSE_deriv.CORPSE_jacobian(asarray(SOM_list,dtype=float),T,theta,params,claymod=params.claymod,model=model)
+
+# Time stepping schemes for vector_iterate. Each one advances the (n_pools,npoints) state array SOM in place over an interval dt
+# rate(y,out) writes the rate of change of state y into out. ws is a dictionary of scratch arrays that is reused between calls
+# The adaptive schemes call rate(y,out,cols) for the points cols (an index array, or None for all points)
+# The adaptive schemes count accepted and rejected steps of each point in stats (a CORPSE_stats.SolverStats)
+
+# Classic fourth order Runge-Kutta with nsub equal substeps
+def advance_rk4(SOM,rate,dt,nsub,ws):
+    from numpy import empty_like,multiply,add
+    if 'rk4' not in ws:
+        ws['rk4']=[empty_like(SOM) for n in range(6)]
+    k1,k2,k3,k4,ytmp,total=ws['rk4']
+    h=dt/nsub
+    for sub in range(nsub):
+        rate(SOM,k1)
+        multiply(k1,h/2,out=ytmp); add(SOM,ytmp,out=ytmp); rate(ytmp,k2)
+        multiply(k2,h/2,out=ytmp); add(SOM,ytmp,out=ytmp); rate(ytmp,k3)
+        multiply(k3,h,out=ytmp); add(SOM,ytmp,out=ytmp); rate(ytmp,k4)
+        add(k2,k3,out=total); multiply(total,2.0,out=total); add(total,k1,out=total); add(total,k4,out=total)
+        multiply(total,h/6,out=total)
+        add(SOM,total,out=SOM)
+
+# Butcher tableaux for the embedded Runge-Kutta schemes: stage coefficients A, solution weights b, error weights e (b minus the
+# lower order weights), and the order of the error estimate. The last stage is evaluated at the new solution, so it is only used for the error
+embedded_tableaux={
+    'rk23':{'A':[[],[1/2],[0,3/4],[2/9,1/3,4/9]],
+            'b':[2/9,1/3,4/9,0],
+            'e':[2/9-7/24,1/3-1/4,4/9-1/3,-1/8],
+            'order':2},
+    'rk45':{'A':[[],[1/5],[3/40,9/40],[44/45,-56/15,32/9],[19372/6561,-25360/2187,64448/6561,-212/729],
+                 [9017/3168,-355/33,46732/5247,49/176,-5103/18656],[35/384,0,500/1113,125/192,-2187/6784,11/84]],
+            'b':[35/384,0,500/1113,125/192,-2187/6784,11/84,0],
+            'e':[35/384-5179/57600,0,500/1113-7571/16695,125/192-393/640,-2187/6784+92097/339200,11/84-187/2100,-1/40],
+            'order':4},
+    }
+
+# Embedded Runge-Kutta scheme with a separate step size and error control for each point
+# Points that have reached the end of the interval stop changing while the others continue. Like advance_rosenbrock, only the points
+# that have not finished are evaluated (rate(y,out,cols)), and cols is the same array until the set of points changes
+def advance_embedded(SOM,rate,dt,tableau,rtol,atol,ws,max_iter=10000,stats=CORPSE_stats.no_stats):
+    from numpy import empty,empty_like,full,zeros,minimum,maximum,abs,sqrt,clip,copyto,add,errstate,arange,flatnonzero,count_nonzero
+    nstages=len(tableau['A'])
+    npoints=SOM.shape[1]
+    def buffers(y):
+        return ([empty_like(y) for n in range(nstages)],empty_like(y),empty_like(y),empty_like(y))
+    if 'embedded' not in ws:
+        ws['embedded']=buffers(SOM)
+        # Step size of each point is kept between output intervals. Starting with the whole interval lets error control choose
+        ws['h']=full(npoints,dt)
+    k,ytmp,ynew,err=ws['embedded']
+    remaining=full(npoints,dt)
+    exponent=-1.0/(tableau['order']+1)
+    accept=zeros(npoints,dtype=bool)
+    idx=arange(npoints)
+    cols=None
+    for n in range(max_iter):
+        active=remaining>0
+        nactive=count_nonzero(active)
+        if nactive==0:
+            return
+        if nactive!=len(idx):
+            idx=cols=flatnonzero(active)
+            k,ytmp,ynew,err=buffers(empty((SOM.shape[0],nactive)))
+        y=SOM if cols is None else SOM[:,idx]
+        h=minimum(ws['h'][idx],remaining[idx])
+        for stage in range(nstages):
+            copyto(ytmp,y)
+            for j,a in enumerate(tableau['A'][stage]):
+                if a!=0:
+                    add(ytmp,k[j]*(h*a),out=ytmp)
+            rate(ytmp,k[stage],cols)
+        copyto(ynew,y)
+        err[:]=0.0
+        for stage in range(nstages):
+            if tableau['b'][stage]!=0:
+                add(ynew,k[stage]*(h*tableau['b'][stage]),out=ynew)
+            if tableau['e'][stage]!=0:
+                add(err,k[stage]*(h*tableau['e'][stage]),out=err)
+        scale=atol+rtol*maximum(abs(y),abs(ynew))
+        errnorm=sqrt(((err/scale)**2).mean(axis=0))
+        ok=errnorm<=1.0
+        accept[:]=False
+        accept[idx]=ok
+        stats.count_sites('accepted_steps',accept)
+        stats.count_sites('rejected_steps',active&~accept)
+        SOM[:,idx[ok]]=ynew[:,ok]
+        remaining[idx[ok]]-=h[ok]
+        # Points within round-off of the end of the interval are finished
+        remaining[remaining<=dt*1e-12]=0.0
+        # Standard step size update, limited so it does not change too fast
+        with errstate(divide='ignore'):
+            factor=clip(0.9*errnorm**exponent,0.2,5.0)
+        ws['h'][idx]=h*factor
+    print('Warning: embedded Runge-Kutta did not finish interval after %d iterations'%max_iter)
+
+# Second order Rosenbrock scheme (ROS2, Verwer et al. 1999) with a separate adaptive step size for each point. Linearly implicit and
+# L-stable, so it stays stable for stiff microbial dynamics where the explicit schemes need very short steps.
+# rate(y,out,cols) and jac(y,cols) give the rates and the (len(cols),n_pools,n_pools) Jacobian for the state y of the points cols
+# (an index array, or None for all points). Only the points that have not finished the interval are evaluated and solved, so the cost
+# of each iteration falls as points finish. cols is the same array until the set of points changes.
+# The error is estimated from the embedded first order solution y+h*k1, which also keeps steps short during rapid microbial growth
+# (positive eigenvalues of the Jacobian), where ROS2 would otherwise damp growth
+def advance_rosenbrock(SOM,rate,jac,dt,nsub,rtol,atol,ws,max_iter=10000,stats=CORPSE_stats.no_stats):
+    from numpy import empty_like,eye,sqrt,full,zeros,minimum,maximum,abs,clip,errstate,flatnonzero,arange,count_nonzero
+    from numpy.linalg import solve
+    npoints=SOM.shape[1]
+    if 'ros2' not in ws:
+        ws['ros2']=eye(SOM.shape[0])
+        ws['h']=full(npoints,dt/nsub)
+    I=ws['ros2']
+    gamma=1.0+1.0/sqrt(2.0)
+    remaining=full(npoints,dt)
+    accept=zeros(npoints,dtype=bool)
+    idx=arange(npoints)
+    cols=None
+    for n in range(max_iter):
+        active=remaining>0
+        nactive=count_nonzero(active)
+        if nactive==0:
+            return
+        # Points only ever finish, so the same index array is passed until one does
+        if nactive!=len(idx):
+            idx=cols=flatnonzero(active)
+        y=SOM[:,idx]
+        h=minimum(ws['h'][idx],remaining[idx])
+        M=I-(gamma*h)[:,None,None]*jac(y,cols)
+        f=rate(y,empty_like(y),cols)
+        k1=solve(M,f.T[:,:,None])[:,:,0].T
+        rate(y+h*k1,f,cols)
+        k2=solve(M,(f-2*k1).T[:,:,None])[:,:,0].T
+        ynew=y+h*(1.5*k1+0.5*k2)
+        err=h*0.5*(k1+k2)
+        errnorm=sqrt(((err/(atol+rtol*maximum(abs(y),abs(ynew))))**2).mean(axis=0))
+        ok=errnorm<=1.0
+        accept[:]=False
+        accept[idx]=ok
+        stats.count_sites('accepted_steps',accept)
+        stats.count_sites('rejected_steps',active&~accept)
+        SOM[:,idx[ok]]=ynew[:,ok]
+        remaining[idx[ok]]-=h[ok]
+        remaining[remaining<=dt*1e-12]=0.0
+        with errstate(divide='ignore'):
+            factor=clip(0.9*errnorm**-0.5,0.2,5.0)
+        ws['h'][idx]=h*factor
+    print('Warning: Rosenbrock scheme did not finish interval after %d iterations'%max_iter)
+
 # Uses an alternate method: Iterating through time steps but loading all points into a vector for more efficient calculation
 # May run faster for large number of points, but potentially less accurate depending on time step
-def vector_iterate(SOM_init,params,T,theta,inputs,clay,times):
-    from numpy import zeros,atleast_1d
+# scheme sets how the state is advanced between output times:
+#   'euler': Forward Euler with one step per output time (the original method)
+#   'rk4': Fourth order Runge-Kutta with substeps steps per output time
+#   'rk23','rk45': Embedded Runge-Kutta pairs with a separate adaptive step size for each point, controlled by rtol and atol
+#   'rosenbrock': Linearly implicit second order Rosenbrock method for stiff conditions, with a separate adaptive step size for each point
+#                 (starting from the output interval divided by substeps)
+# Temperature and moisture are held constant over each output interval in all schemes
+# backend='numba' uses the compiled kernels in CORPSE_kernels for the 'euler' and 'rk4' schemes, which calculate the rates and update
+# the state in one pass over the points. If numba is not installed, the numpy version is used instead
+# sink is an output sink from CORPSE_output that decides what is kept from each time step. The default (FullOutput) keeps everything
+# and returns a dictionary of (npoints,len(times)) arrays for the pools in SOM_init
+# stats is a CORPSE_stats.SolverStats that is filled in with counts and timings of the run
+# disturbance is a CORPSE_disturbance.FireSchedule. Steps with fires are split so that each fire happens at exactly its time
+# model is a CORPSE_array.CORPSEModel that sets the C types (default is the model params were compiled for, or the default model)
+def vector_iterate(SOM_init,params,T,theta,inputs,clay,times,scheme='euler',substeps=1,rtol=1e-6,atol=1e-9,sink=None,backend='numpy',stats=None,disturbance=None,
+                   model=None):
+    import CORPSE_output
+    from numpy import atleast_1d
+    model=get_model(model,params)
+    if sink is None:
+        sink=CORPSE_output.FullOutput()
+    if stats is None:
+        stats=CORPSE_stats.no_stats
+    stats.start('vector_iterate')
+    try:
+        for step,SOM in vector_steps(SOM_init,params,T,theta,inputs,clay,times,scheme,substeps,rtol,atol,backend,stats,disturbance,model,initial=True):
+            with stats.timer('output'):
+                if step<0:
+                    fields=list(SOM_init.keys())
+                    sink.start(fields,[model.pool_index[f] for f in fields],SOM.shape[1],atleast_1d(times))
+                    if hasattr(sink,'initial'):
+                        sink.initial(SOM)
+                    continue
+                sink.record(step,times[step],SOM)
+        with stats.timer('output'):
+            result=sink.finish()
+    finally:
+        stats.finish()
+    return result
+
+# Stream the output of vector_iterate in chunks of time steps instead of keeping it all in memory
+# Yields (times,data) for each chunk, where data is a dictionary of pool name: array of shape (npoints,steps in chunk)
+# Other arguments are the same as vector_iterate
+def vector_iterate_chunks(SOM_init,params,T,theta,inputs,clay,times,chunk=100,**kwargs):
+    import CORPSE_output
+    from numpy import atleast_1d
+    chunks=[]
+    sink=CORPSE_output.CallbackOutput(lambda t,data: chunks.append((t,data)),chunk=chunk)
+    model=get_model(kwargs.get('model'),params)
+    for step,SOM in vector_steps(SOM_init,params,T,theta,inputs,clay,times,**kwargs):
+        if step==0:
+            fields=list(SOM_init.keys())
+            sink.start(fields,[model.pool_index[f] for f in fields],SOM.shape[1],atleast_1d(times))
+        sink.record(step,times[step],SOM)
+        while chunks:
+            yield chunks.pop(0)
+    sink.finish()
+    while chunks:
+        yield chunks.pop(0)
+
+# Time stepping loop behind vector_iterate. Yields (step,SOM) after each step, where SOM is the (n_pools,npoints) state array
+# (rows in the model's array_pools order). The same array is updated in place at every step
+# If initial is True, it first yields (-1,SOM) with the initial state, before any step
+def vector_steps(SOM_init,params,T,theta,inputs,clay,times,scheme='euler',substeps=1,rtol=1e-6,atol=1e-9,backend='numpy',stats=None,disturbance=None,
+                 model=None,initial=False):
+    from numpy import zeros,empty,empty_like,asarray,add,multiply,broadcast_to,ndim,size
     # totaltime and dt in units of years
     nsteps=len(times)
-    if len(T.shape)>1:
+    # T can also be a forcing object from CORPSE_forcing, which gives both temperature and moisture (theta is then ignored)
+    # T and theta can be scalars (the same at every point and step), one value per point, or (len(times),npoints) arrays
+    forcing=None
+    periodic=False
+    if hasattr(T,'at'):
+        forcing=T
+        npoints=forcing.npoints
+        constant=forcing.constant
+        periodic=forcing.periodic
+    elif ndim(T)>1:
         npoints=T.shape[1]
+        constant=False
+    else:
+        npoints=size(T)
+        constant=True
+    # Forcing, clay and initial values can each have one value or one value per point
+    sizes=set([npoints,size(clay)]+[size(SOM_init[f]) for f in SOM_init.keys()])-set([1])
+    if len(sizes)>1:
+        raise ValueError('Forcing, clay and initial values have different numbers of points: %s'%sorted(sizes))
+    npoints=sizes.pop() if sizes else 1
+    # Vmax is only remembered when temperature is constant (under a fixed key) or repeats exactly (under the forcing's key, e.g. its
+    # record index). Looking temperature arrays up by their contents costs about as much as calculating Vmax, and finds little
+    # when temperature changes every step
+    cache_vmax=constant or periodic
+    vmax_key=0 if constant else None
+    # params can also be a CompiledParams from an earlier run, which is reused unless its parameter values have changed
+    model=get_model(model,params)
+    if isinstance(params,CORPSE_deriv.CompiledParams):
+        params.refresh(clay=clay)
+        params.clear_vmax()
+        compiled=params
     else:
-        npoints=len(T)
-    nrecords=nsteps
+        compiled=CORPSE_deriv.CompiledParams(params,clay=clay,cache_vmax=cache_vmax,model=model)
+    # Parameters can have one value per point (for example a parameter ensemble), in which case they can also set the number of points
+    npoints=CORPSE_deriv.check_params(compiled.source,npoints if npoints>1 else None,model) or npoints
 
-    # Set up pools
-    SOM={}
-    SOM_out={}
+    # Set up pools. The state is one (n_pools,npoints) array with rows in the model's array_pools order
+    pool_index=model.pool_index
+    SOM=zeros((len(model.array_pools),npoints))
     for field in SOM_init.keys():
-        SOM_out[field]=zeros((npoints,nrecords))
-        if len(atleast_1d(SOM_init['uFastC'])) == 1: 
-            SOM[field]=zeros(npoints)+SOM_init[field]
-        else:
-            SOM[field]=SOM_init[field].values
+        SOM[pool_index[field]]=asarray(SOM_init[field],dtype=float)
+    deriv=empty_like(SOM)
+    work=CORPSE_deriv.deriv_workspace(npoints,model)
 
-    # Iterate through simulations
-    for step in range(nsteps):
-        if step==nsteps-1:
-            dt=times[step]-times[step-1]
-        else:
-            dt=times[step+1]-times[step]
-        if len(T.shape)>1:
-            T_step=T[step,:]
+    # Since we have carbon inputs, these also need to be added to those rates of change with time. They are constant, so set them up once
+    input_rates=zeros((len(model.array_pools),npoints))
+    for pool in inputs.keys():
+        input_rates[pool_index[pool]]=inputs[pool]
+
+    if scheme not in ['euler','rk4','rosenbrock']+list(embedded_tableaux.keys()):
+        raise ValueError('Unknown time stepping scheme %s'%scheme)
+    if backend not in ['numpy','numba']:
+        raise ValueError('Unknown backend %s'%backend)
+    if backend=='numba':
+        import CORPSE_kernels
+        if scheme not in ['euler','rk4']:
+            raise ValueError('The numba backend only supports the euler and rk4 schemes')
+        if not CORPSE_kernels.available:
+            print('Warning: numba is not installed, using numpy backend')
+            backend='numpy'
         else:
-            T_step=T
-        if len(theta.shape)>1:
-            theta_step=theta[step,:]
+            kernel_params=CORPSE_kernels.kernel_params(compiled,npoints)
+            kernel_inputs=CORPSE_kernels.kernel_inputs(input_rates)
+            kernel_layout=CORPSE_kernels.kernel_layout(model)
+            moisture=empty(npoints)
+            vmax_work=empty((model.nchem,npoints))
+
+    # Rate of change (including inputs) and Jacobian at the current time step's temperature and moisture
+    # cols selects a subset of the points (index array), as the adaptive schemes use for points that have not finished their interval
+    def rate(y,out,cols=None):
+        if cols is None:
+            CORPSE_deriv.CORPSE_deriv_array(y,T_step,theta_step,compiled,compiled.claymod,out=out,work=work,vmax_key=vmax_key)
+            add(out,input_rates,out=out)
         else:
-            theta_step=theta
-        # In this case, T, theta, clay, and all the pools in SOM are vectors containing one value per geographical location
-        deriv=CORPSE_deriv.CORPSE_deriv(SOM,T_step,theta_step,params,claymod=CORPSE_deriv.prot_clay(clay.values)/CORPSE_deriv.prot_clay(20))
+            sub,sub_inputs,sub_work=columns(cols)
+            CORPSE_deriv.CORPSE_deriv_array(y,at_columns(T_step,cols),at_columns(theta_step,cols),sub,sub.claymod,out=out,work=sub_work)
+            add(out,sub_inputs,out=out)
+        return out
+    def jac(y,cols=None):
+        if cols is None:
+            return CORPSE_deriv.CORPSE_jacobian(y,T_step,theta_step,compiled,compiled.claymod)
+        sub=columns(cols)[0]
+        return CORPSE_deriv.CORPSE_jacobian(y,at_columns(T_step,cols),at_columns(theta_step,cols),sub,sub.claymod)
+    # Parameters, inputs and workspace of the points cols, only set up again when cols changes
+    subset={}
+    def columns(cols):
+        if subset.get('cols') is not cols:
+            subset.update(cols=cols,params=compiled.columns(cols,npoints),inputs=input_rates[:,cols],work=CORPSE_deriv.deriv_workspace(len(cols),model))
+        return subset['params'],subset['inputs'],subset['work']
+    def at_columns(value,cols):
+        return value[cols] if ndim(value)>0 and size(value)>1 else value
+    scheme_work={}
+    if disturbance is not None:
+        disturbance.check_points(npoints,model)
 
-        # Since we have carbon inputs, these also need to be added to those rates of change with time
-        for pool in inputs.keys():
-            deriv[pool]+=inputs[pool]
+    # Advance SOM over an interval dt (at the current step's temperature and moisture)
+    def advance(dt):
+        if dt<=0:
+            return
+        if backend=='numba':
+            with stats.timer('kernel'):
+                if scheme=='euler':
+                    CORPSE_kernels.euler_step(SOM,dt,vmax,moisture,kernel_inputs,kernel_params,kernel_layout,deriv)
+                else:
+                    if 'rk4' not in scheme_work:
+                        scheme_work['rk4']=[empty_like(SOM) for n in range(5)]
+                    CORPSE_kernels.rk4_step(SOM,dt,substeps,vmax,moisture,kernel_inputs,kernel_params,kernel_layout,*scheme_work['rk4'])
+        elif scheme=='euler':
+            rate(SOM,deriv)
+            multiply(deriv,dt,out=deriv)
+            add(SOM,deriv,out=SOM)
+        elif scheme=='rk4':
+            advance_rk4(SOM,rate,dt,substeps,scheme_work)
+        elif scheme=='rosenbrock':
+            advance_rosenbrock(SOM,rate,jac,dt,substeps,rtol,atol,scheme_work,stats=stats)
+        else:
+            advance_embedded(SOM,rate,dt,embedded_tableaux[scheme],rtol,atol,scheme_work,stats=stats)
 
-        for field in deriv.keys():
-            SOM[field]=SOM[field]+deriv[field]*dt
+    # Statistics are only collected if they were asked for, so there is no overhead otherwise
+    if stats is None:
+        stats=CORPSE_stats.no_stats
+    rate=stats.timed('rhs',rate)
+    jac=stats.timed('jacobian',jac)
+    stats.start('vector_steps',npoints)
+    try:
+        if initial:
+            yield -1,SOM
+        # Iterate through simulations
+        for step in range(nsteps):
+            if step==nsteps-1:
+                dt=times[step]-times[step-1]
+            else:
+                dt=times[step+1]-times[step]
+            if forcing is not None:
+                with stats.timer('forcing'):
+                    T_step,theta_step=forcing.at(times[step])
+                if periodic:
+                    vmax_key=forcing.key
+            else:
+                if ndim(T)>1:
+                    T_step=T[step,:]
+                else:
+                    T_step=T
+                if ndim(theta)>1:
+                    theta_step=theta[step,:]
+                else:
+                    theta_step=theta
+            # In this case, T, theta, clay, and all the pools in SOM are vectors containing one value per geographical location
+            if backend=='numba':
+                with stats.timer('kernel'):
+                    vmax=broadcast_to(compiled.vmax(T_step,out=vmax_work,key=vmax_key),vmax_work.shape)
+                    CORPSE_kernels.moisture_array(theta_step,compiled.arrays,compiled.aerobic_max,out=moisture)
+            if disturbance is None:
+                advance(dt)
+            else:
+                # Fires during the step split it, and each part is advanced separately
+                t=times[step]
+                for event in disturbance.events_between(t,times[step]+dt):
+                    advance(disturbance.times[event]-t)
+                    apply_disturbance(disturbance,SOM,event,stats)
+                    t=disturbance.times[event]
+                advance(times[step]+dt-t)
+            stats.count('steps')
 
-        if (step*dt)%10==0:
-            print('Time = %d'%(step*dt))
-        for field in SOM.keys():
-            SOM_out[field][:,step]=SOM[field]
+            if (step*dt)%10==0:
+                print('Time = %d'%(step*dt))
+            yield step,SOM
+    finally:
+        stats.finish()
 
-    return SOM_out
+# Apply one event of a disturbance schedule (CORPSE_disturbance.FireSchedule) to the (n_pools,npoints) state array SOM, in place
+def apply_disturbance(disturbance,SOM,event,stats=CORPSE_stats.no_stats):
+    disturbance.apply(SOM,event)
+    if stats.enabled:
+        stats.count_sites('fires',disturbance.burned(event,SOM.shape[1]))
 
 # This function runs an actual simulation using the ODE solver
 # Tmin and Tmax allow a sinusoidal temperature variation. Similar for thetamin and thetamax. Set min and max equal for constant state
@@ -99,14 +454,63 @@ def vector_iterate(SOM_init,params,T,theta,inputs,clay,times):
 # initvals is a dictionary of the initial values for all pools
 # params is a dictionary of all the parameter values
 # inputs is a dictionary of the C input rates of all pools. Assumes zero rate for pools not in the inputs data structure (so it can be empty for no inputs)
-def run_models_ODE(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals):
+# batched=True integrates all points together in one call to solve_ivp (using the given method) instead of one odeint call per point
+# forcing is a forcing object from CORPSE_forcing (e.g. daily records or post-fire heating) that replaces the sinusoidal cycle.
+# It always uses the batched integrator, and Tmin, Tmax, thetamin and thetamax are ignored
+# stats is a CORPSE_stats.SolverStats that is filled in with counts and timings of the run. For the odeint loop these include
+# the number of steps and rate and Jacobian calls of each point
+# disturbance is a CORPSE_disturbance.FireSchedule of fires to apply during the run. Like forcing, it always uses the batched integrator,
+# which stops at each fire time. Outputs at the time of a fire are after the fire
+# model is a CORPSE_array.CORPSEModel that sets the C types and pools (default is the default model). Outputs have a column for each of its fields
+# cache is a CORPSE_cache.ResultCache. If a run with exactly the same inputs and solver settings is already in it, the stored result is
+# returned (as DataFrames backed by memory-mapped arrays) without running the model. Otherwise the result is added to it
+def run_models_ODE(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals,batched=False,method='LSODA',forcing=None,stats=None,disturbance=None,
+                   model=None,cache=None):
     import time,pandas
-    from numpy import atleast_1d
+    from numpy import atleast_1d,broadcast_to,size
     t0=time.time()
     from scipy.integrate import odeint
     # Again, start with an empty list to hold the output
     SOM_out_ODE=[]
     print('ODE integrator')
+    if stats is None:
+        stats=CORPSE_stats.no_stats
+    model=get_model(model,params)
+    if isinstance(params,CORPSE_deriv.CompiledParams):
+        params=params.source
+    fields=model.fields
+
+    key=None
+    if cache is not None:
+        key=cache.key('run_models_ODE',Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals,batched,method,forcing,disturbance,model)
+        if key is None:
+            print('Forcing cannot be cached, running without the cache')
+        else:
+            stored=cache.get(key)
+            if stored is not None:
+                print('Loaded from cache')
+                return stored.to_dataframes()
+
+    # Number of points. Climate, clay and parameters can each have one value, or one value per point
+    npoints=max([size(v) for v in (Tmin,Tmax,thetamin,thetamax,clay)])
+    npoints=CORPSE_deriv.check_params(params,npoints if npoints>1 else None,model) or npoints
+
+    if batched or forcing is not None or disturbance is not None:
+        if forcing is not None:
+            npoints=max(npoints,forcing.npoints)
+        if disturbance is not None:
+            npoints=max(npoints,disturbance.npoints)
+        stats.start('run_models_ODE',npoints)
+        try:
+            result=integrate_batched(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals_array(initvals,npoints,model),method=method,forcing=forcing,
+                                     stats=stats,disturbance=disturbance,model=model)
+            with stats.timer('output'):
+                for point in range(npoints):
+                    SOM_out_ODE.append(pandas.DataFrame(result[point],columns=fields,index=times))
+        finally:
+            stats.finish()
+        print('Time elapsed: %1.1f s'%(time.time()-t0))
+        return cache_results(cache,key,SOM_out_ODE)
 
 
     def get_initvals(initvals,point):
@@ -125,51 +529,445 @@ def run_models_ODE(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals
 
         return ivals
 
-    for point in range(len(atleast_1d(clay))):
-        print('Point %d of %d'%(point,len(atleast_1d(clay))))
+    def at_point(value,point):
+        return broadcast_to(atleast_1d(value),(npoints,))[point]
 
-        ivals=get_initvals(initvals,point)
+    stats.start('run_models_ODE',npoints)
+    try:
+        # When collecting statistics, the rate and Jacobian functions are wrapped to count and time their calls
+        func=stats.timed('rhs',ode_wrapper)
+        Dfun=stats.timed('jacobian',ode_jacobian)
+        for point in range(npoints):
+            print('Point %d of %d'%(point,npoints))
 
-        # Runs the ODE integrator
-        result=odeint(ode_wrapper,ivals,times,
-            args=(atleast_1d(Tmax)[point]+273.15,atleast_1d(Tmin)[point]+273.15,atleast_1d(thetamax)[point],atleast_1d(thetamin)[point],inputs,atleast_1d(clay)[point],params))
-        # Store the output in a pandas DataFrame (similar to R's dataframes)
-        result_df=pandas.DataFrame(result[:,:len(fields)],columns=fields,index=times)
+            ivals=get_initvals(initvals,point)
 
-        # Add it to the list of the output from each point
-        SOM_out_ODE.append(result_df)
+            # Runs the ODE integrator. Parameters are compiled once for each point, and carry the model and the clay modifier with them
+            # Temperature changes at every call, so there is no point in caching Vmax
+            args=(at_point(Tmax,point)+273.15,at_point(Tmin,point)+273.15,at_point(thetamax,point),at_point(thetamin,point),inputs,at_point(clay,point),
+                  model.compile(CORPSE_deriv.point_params(params,point),clay=at_point(clay,point),cache_vmax=False))
+            if stats.enabled:
+                calls_before=(stats.counts.get('rhs_calls',0),stats.counts.get('jacobian_calls',0))
+                with stats.timer('integrate'):
+                    result,info=odeint(func,ivals,times,Dfun=Dfun,args=args+(stats,),full_output=True)
+                stats.count_sites('steps',info['nst'][-1],point)
+                stats.set_site('rhs_calls',point,stats.counts.get('rhs_calls',0)-calls_before[0])
+                stats.set_site('jacobian_calls',point,stats.counts.get('jacobian_calls',0)-calls_before[1])
+                stats.site_memory(point)
+            else:
+                result=odeint(ode_wrapper,ivals,times,Dfun=ode_jacobian,args=args)
+            # Store the output in a pandas DataFrame (similar to R's dataframes)
+            with stats.timer('output'):
+                result_df=pandas.DataFrame(result[:,:len(fields)],columns=fields,index=times)
 
+            # Add it to the list of the output from each point
+            SOM_out_ODE.append(result_df)
 
+    finally:
+        stats.finish()
     print('Time elapsed: %1.1f s'%(time.time()-t0))
 
-    return SOM_out_ODE
+    return cache_results(cache,key,SOM_out_ODE)
+
+# Add results to a CORPSE_cache.ResultCache under key (if a cache is used) and return them
+def cache_results(cache,key,results):
+    if cache is not None and key is not None:
+        cache.put(key,results)
+    return results
+
+# Set initial values for all points into one (npoints,len(model.fields)) array for the batched solver
+# initvals can be a dictionary (same values, or one value per point, for each pool), a DataFrame with one row per point,
+# a list of DataFrames from a previous simulation (uses the last time step), or a list of numbers in the order of fields
+# DataFrames are recognized without importing pandas, so runs from arrays (e.g. CORPSE_cli) do not need it
+def initvals_array(initvals,npoints,model=None):
+    from numpy import zeros,asarray,atleast_1d
+    fields=get_model(model).fields
+    ivals=zeros((npoints,len(fields)))
+    if isinstance(initvals,dict) or hasattr(initvals,'columns'):
+        for n,f in enumerate(fields):
+            ivals[:,n]=asarray(initvals[f],dtype=float)
+    elif hasattr(initvals[0],'iloc'):
+        for point in range(npoints):
+            ivals[point,:]=[initvals[point].iloc[-1][f] for f in fields]
+    else:
+        ivals[:,:]=atleast_1d(asarray(initvals,dtype=float))[:len(fields)]
+    return ivals
+
+# Right-hand side and Jacobian of the batched ODE. The state vector holds all pools for point 0, then all pools for point 1, and so on,
+# so the state can be viewed as a (npoints,len(fields)) array and its transpose is the (n_pools,n_points) layout CORPSE_deriv_array expects
+# forcing is a forcing object from CORPSE_forcing that gives temperature and moisture at each time
+# jac_format is 'banded' for the packed banded format LSODA uses, or 'sparse' for a sparse matrix (BDF, Radau)
+# model is the CORPSE_array.CORPSEModel. The pools of each point are the model's fields
+def make_batched_rhs(forcing,inputs,clay,params,npoints,jac_format='sparse',model=None):
+    from numpy import zeros,empty,add,arange
+    from scipy.sparse import csc_matrix
+    model=get_model(model)
+    nfields=len(model.fields)
+    # Vmax only needs to be calculated once if temperature is constant
+    aparams=CORPSE_deriv.CompiledParams(params,clay=clay,cache_vmax=forcing.constant,model=model)
+    vmax_key=0 if forcing.constant else None
+    claymod=aparams.claymod
+    work=CORPSE_deriv.deriv_workspace(npoints,model)
+    # Inputs are constant, so put them into an array once
+    input_rates=zeros((npoints,nfields))
+    for pool in inputs.keys():
+        input_rates[:,model.pool_index[pool]]=inputs[pool]
+
+    def rhs(time,SOM_vector):
+        T,theta=forcing.at(time)
+        deriv=empty((npoints,nfields))
+        CORPSE_deriv.CORPSE_deriv_array(SOM_vector.reshape(npoints,nfields).T,T,theta,aparams,claymod,out=deriv.T,work=work,vmax_key=vmax_key)
+        add(deriv,input_rates,out=deriv)
+        return deriv.ravel()
+
+    # Positions of the entries of each point's (len(fields),len(fields)) Jacobian block in the full Jacobian
+    a,b=(arange(nfields)[:,None]+zeros((1,nfields),dtype=int)),(arange(nfields)[None,:]+zeros((nfields,1),dtype=int))
+    block_start=(arange(npoints)*nfields)[:,None,None]
+    if jac_format=='banded':
+        # Packed banded format: jac_packed[uband+i-j,j]=jac[i,j]
+        band_rows=(nfields-1+a-b)[None,:,:]+zeros((npoints,1,1),dtype=int)
+        band_cols=block_start+b[None,:,:]
+    else:
+        sparse_rows=(block_start+a[None,:,:]).ravel()
+        sparse_cols=(block_start+b[None,:,:]).ravel()
+
+    def jac(time,SOM_vector):
+        T,theta=forcing.at(time)
+        J=CORPSE_deriv.CORPSE_jacobian(SOM_vector.reshape(npoints,nfields).T,T,theta,aparams,claymod)
+        if jac_format=='banded':
+            packed=zeros((2*nfields-1,npoints*nfields))
+            packed[band_rows,band_cols]=J
+            return packed
+        else:
+            return csc_matrix((J.ravel(),(sparse_rows,sparse_cols)),shape=(npoints*nfields,npoints*nfields))
+
+    return rhs,jac
+
+# Integrate all points in a single call to scipy's solve_ivp
+# Tmin and Tmax are in degrees C. ivals is an (npoints,len(fields)) array of initial values (see initvals_array)
+# forcing is a forcing object from CORPSE_forcing. If given, it is used instead of the sinusoidal cycle set by Tmin, Tmax, thetamin and thetamax
+# stats is a CORPSE_stats.SolverStats that is filled in with counts and timings of the run
+# disturbance is a CORPSE_disturbance.FireSchedule. The integration is split into segments between fires, and each segment starts
+# from the state at the end of the previous one after the fire is applied. Outputs at the time of a fire are after the fire
+# model is a CORPSE_array.CORPSEModel (default is the default model)
+# Returns an array of shape (npoints,len(times),len(model.fields))
+def integrate_batched(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,ivals,method='LSODA',rtol=1.49012e-8,atol=1.49012e-8,forcing=None,stats=None,
+                      disturbance=None,model=None):
+    import CORPSE_forcing
+    from scipy.integrate import solve_ivp
+    from scipy.sparse import kron,identity
+    from numpy import ones,asarray,empty,searchsorted,append,nextafter,inf
+    model=get_model(model,params)
+    if isinstance(params,CORPSE_deriv.CompiledParams):
+        params=params.source
+    npoints,nfields=ivals.shape
+    if nfields!=len(model.fields):
+        raise ValueError('Initial values have %d pools but the model has %d'%(nfields,len(model.fields)))
+    CORPSE_deriv.check_params(params,npoints,model)
+    times=asarray(times,dtype=float)
+    if forcing is None:
+        forcing=CORPSE_forcing.SinusoidalForcing(Tmin,Tmax,thetamin,thetamax)
+    if stats is None:
+        stats=CORPSE_stats.no_stats
+    stats.start('integrate_batched',npoints)
+    try:
+        rhs,jac=make_batched_rhs(forcing,inputs,clay,params,npoints,jac_format='banded' if method=='LSODA' else 'sparse',model=model)
+        rhs=stats.timed('rhs',rhs)
+        jac=stats.timed('jacobian',jac)
+
+        # Pools only interact within a point, so the Jacobian is block diagonal
+        options={}
+        if method=='LSODA':
+            options['lband']=nfields-1
+            options['uband']=nfields-1
+            options['jac']=jac
+        elif method in ['BDF','Radau']:
+            options['jac_sparsity']=kron(identity(npoints),ones((nfields,nfields)),format='csc')
+            options['jac']=jac
+
+        if disturbance is None:
+            with stats.timer('integrate'):
+                sol=solve_ivp(rhs,(times[0],times[-1]),ivals.ravel(),method=method,t_eval=times,rtol=rtol,atol=atol,**options)
+            stats.count('lu_decompositions',sol.nlu)
+            if not sol.success:
+                print('Warning: ODE integrator did not finish: %s'%sol.message)
+            result=sol.y.reshape(npoints,nfields,-1).transpose(0,2,1)
+            return result
+
+        # With disturbances, integrate up to each fire, apply it and restart from there. Results are written into one array as each segment finishes
+        disturbance.check_points(npoints,model)
+        result=empty((npoints,len(times),nfields))
+        y=ivals.ravel().copy()
+        start=times[0]
+        first=0
+        # Fires at the end time are included, so the last output is after them
+        for event in list(disturbance.events_between(times[0],nextafter(times[-1],inf)))+[None]:
+            end=times[-1] if event is None else disturbance.times[event]
+            # Output times in this segment. The last segment includes the end time. The others stop just before the fire, and the state
+            # at the fire is added as an extra output time to restart from
+            if event is None:
+                last=len(times)
+                t_eval=times[first:]
+            else:
+                last=searchsorted(times,end,side='left')
+                t_eval=append(times[first:last],end)
+            # Fires at the same time up to rounding error are applied one after the other, without integrating in between
+            if end-start>1e-10*max(abs(end),1.0):
+                with stats.timer('integrate'):
+                    sol=solve_ivp(rhs,(start,end),y,method=method,t_eval=t_eval,rtol=rtol,atol=atol,**options)
+                stats.count('lu_decompositions',sol.nlu)
+                if not sol.success:
+                    raise RuntimeError('ODE integrator failed at time %g: %s'%(sol.t[-1] if len(sol.t) else start,sol.message))
+                result[:,first:last,:]=sol.y[:,:last-first].reshape(npoints,nfields,-1).transpose(0,2,1)
+                y=sol.y[:,-1].copy()
+            else:
+                result[:,first:last,:]=y.reshape(npoints,nfields)[:,None,:]
+            if event is not None:
+                # The state vector viewed as (n_pools,npoints), the layout the disturbance works on
+                apply_disturbance(disturbance,y.reshape(npoints,nfields).T,event,stats)
+            start=end
+            first=last
+    finally:
+        stats.finish()
+    return result
+
+# Runs one scenario of an ensemble with the batched ODE solver. This runs in a worker process, so it returns arrays rather than DataFrames
+# to keep the cost of sending results back small. Errors are caught and returned so one failed scenario does not stop the others
+def ensemble_task(task):
+    name,params,ivals,forcing,method,model=task
+    try:
+        result=integrate_batched(forcing['Tmin'],forcing['Tmax'],forcing['thetamin'],forcing['thetamax'],forcing['times'],
+                                 forcing.get('inputs',{}),params,forcing['clay'],ivals,method=method,model=model)
+        return name,result,None
+    except Exception:
+        import traceback
+        return name,None,traceback.format_exc()
+
+# Run many scenarios (e.g. sets of parameters and initial values for different functional types) across a pool of processes
+# scenarios is a dictionary of scenario name: (params, initvals, forcing)
+#   forcing is a dictionary with the other arguments of run_models_ODE: Tmin, Tmax, thetamin, thetamax, times, clay, and optionally inputs
+# max_workers is the number of processes (default is the number of CPUs). max_workers=1 runs everything in this process
+# chunksize is the number of scenarios sent to a worker at a time. Larger chunks reduce overhead when there are many small scenarios
+# Returns two dictionaries, both in the same order as scenarios:
+#   results: scenario name: list of DataFrames (one per point, like run_models_ODE), or arrays of shape (npoints,len(times),len(fields)) if as_dataframes is False
+#   errors: scenario name: traceback for scenarios that failed
+# model is a CORPSE_array.CORPSEModel used for all scenarios (default is the default model)
+def run_ensemble(scenarios,max_workers=None,chunksize=1,method='LSODA',as_dataframes=True,model=None):
+    import time
+    from numpy import size
+    from concurrent.futures import ProcessPoolExecutor
+    t0=time.time()
+    model=get_model(model)
+
+    # Initial values are converted to arrays here so workers are not sent DataFrames
+    # The number of points is set by the forcing, or by parameters with one value per point (e.g. a calibration ensemble)
+    tasks=[]
+    for name in scenarios:
+        params,initvals,forcing=scenarios[name]
+        npoints=max([size(forcing[k]) for k in ('Tmin','Tmax','thetamin','thetamax','clay')])
+        npoints=CORPSE_deriv.check_params(params,npoints if npoints>1 else None,model) or npoints
+        tasks.append((name,params,initvals_array(initvals,npoints,model),forcing,method,model))
+
+    print('Running %d scenarios'%len(tasks))
+    if max_workers==1:
+        output=list(map(ensemble_task,tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            output=list(executor.map(ensemble_task,tasks,chunksize=chunksize))
+
+    results={}
+    errors={}
+    for name,result,error in output:
+        if error is not None:
+            print('Scenario %s failed:\n%s'%(name,error))
+            errors[name]=error
+        elif as_dataframes:
+            import pandas
+            times=scenarios[name][2]['times']
+            results[name]=[pandas.DataFrame(result[point],columns=model.fields,index=times) for point in range(result.shape[0])]
+        else:
+            results[name]=result
+
+    print('Time elapsed: %1.1f s'%(time.time()-t0))
+    return results,errors
+
+# Solve for the steady state (equilibrium) of all pools with constant temperature, moisture and C inputs, for example to set initial pools
+# T is temperature (degrees C) and theta is soil moisture (fraction of saturation), either scalars or one value per point
+# clay is % clay; one value per point sets the number of points (parameters with one value per point can also set it)
+# initvals is the starting guess (anything initvals_array accepts). If None, starts from one year of inputs in each pool
+# All points are solved together with Newton iterations using the analytic Jacobian. Points that do not converge within maxiter
+# fall back to accelerated spin-up from the initial guess (pseudo-transient continuation: implicit steps, starting at spinup_dt years,
+# whose length grows as the pools approach steady state until they become Newton iterations)
+# Converged when every rate of change is less than tol times the total input rate at that point
+# Returns a DataFrame with one row per point and a column for each pool in the model's fields (with CO2 set to zero), which can be used as initvals
+# model is a CORPSE_array.CORPSEModel (default is the default model)
+def solve_steady_state(T,theta,inputs,params,clay,initvals=None,tol=1e-10,maxiter=20,spinup_steps=1000,spinup_dt=0.1,model=None):
+    import pandas,time
+    from numpy import zeros,ones,asarray,atleast_1d,abs,eye,maximum,minimum,where,isfinite
+    from numpy.linalg import solve,LinAlgError
+    t0=time.time()
+    model=get_model(model,params)
+    if isinstance(params,CORPSE_deriv.CompiledParams):
+        params=params.source
+    npoints=len(atleast_1d(clay))
+    npoints=CORPSE_deriv.check_params(params,npoints if npoints>1 else None,model) or npoints
+    fields=model.fields
+    nfields=len(fields)
+    compiled=CORPSE_deriv.CompiledParams(params,clay=clay,model=model)
+    T=zeros(npoints)+asarray(T,dtype=float)+273.15
+    theta=zeros(npoints)+asarray(theta,dtype=float)
+    input_rates=zeros((nfields,npoints))
+    for pool in inputs.keys():
+        input_rates[model.pool_index[pool]]=inputs[pool]
+    input_total=abs(input_rates).sum(axis=0)
+    if (input_total==0).any():
+        print('Warning: Some points have no C inputs, so their only steady state has no C')
+
+    # Cumulative CO2 never reaches steady state, so it is left out of the equations
+    rows=[n for n in range(nfields) if n!=model.co2_row]
+    nrows=len(rows)
+    I=eye(nrows)
+
+    if initvals is None:
+        SOM=zeros((nfields,npoints))
+        SOM[model.u_rows]=input_total
+        SOM[model.p_rows]=input_total
+        SOM[model.mic_row]=0.1*input_total
+    else:
+        SOM=initvals_array(initvals,npoints,model).T.copy()
+    SOM[model.co2_row]=0.0
+
+    work=CORPSE_deriv.deriv_workspace(npoints,model)
+    deriv=zeros((nfields,npoints))
+    def residual(y):
+        # Temperature is constant, so Vmax is calculated once and then looked up
+        CORPSE_deriv.CORPSE_deriv_array(y,T,theta,compiled,compiled.claymod,out=deriv,work=work,vmax_key=0)
+        return (deriv+input_rates)[rows]
+    def jacobian(y):
+        J=CORPSE_deriv.CORPSE_jacobian(y,T,theta,compiled,compiled.claymod)
+        return J[:,rows,:][:,:,rows]
+    def size(F):
+        return abs(F).max(axis=0)/where(input_total>0,input_total,1.0)
+
+    # dt is the implicit step length for each point. Infinite dt is a Newton iteration
+    guess=SOM.copy()
+    dt=zeros(npoints)+float('inf')
+    F=residual(SOM)
+    err=size(F)
+    for iteration in range(maxiter+spinup_steps):
+        active=err>tol
+        if not active.any():
+            break
+        if iteration==maxiter:
+            # Points that have not converged restart from the initial guess with accelerated spin-up, starting from short steps
+            print('Steady state: %d of %d points not converged after %d Newton iterations, switching to accelerated spin-up'%(active.sum(),npoints,maxiter))
+            SOM=where(active,guess,SOM)
+            F=residual(SOM)
+            err=size(F)
+            dt=where(active,spinup_dt,dt)
+        M=-jacobian(SOM)+I*(1.0/dt)[:,None,None]
+        step=zeros(F.shape)
+        ok=active.copy()
+        try:
+            step[:,active]=solve(M[active],F[:,active].T[:,:,None])[:,:,0].T
+        except LinAlgError:
+            for n in active.nonzero()[0]:
+                try:
+                    step[:,n]=solve(M[n],F[:,n])
+                except LinAlgError:
+                    ok[n]=False
+
+        # Newton steps are shortened until the residual decreases and pools stay non-negative
+        frac=ones(npoints)
+        trial=SOM.copy()
+        for halving in range(30 if iteration<maxiter else 1):
+            trial[rows]=SOM[rows]+step*frac
+            Ftrial=residual(trial)
+            err_trial=size(Ftrial)
+            # Microbial biomass has to stay above zero, because zero biomass is a dead end with no decomposition
+            good=ok&(trial[rows]>=0).all(axis=0)&(trial[model.mic_row]>0)&isfinite(err_trial)&((err_trial<err)|(dt<float('inf')))
+            if (good|~active).all():
+                break
+            frac=where(good,frac,frac*0.5)
+        SOM=where(good,trial,SOM)
+        if iteration>=maxiter:
+            # Spin-up steps get longer after each successful step, faster if the rates are shrinking quickly (switched evolution relaxation),
+            # and shorter if a step failed
+            dt=where(good,minimum(dt*minimum(maximum(err/maximum(err_trial,1e-300),2.0),10.0),1e15),maximum(dt*0.25,1e-10))
+        F=where(good,Ftrial,F)
+        err=where(good,err_trial,err)
+
+    if (err>tol).any():
+        print('Warning: Steady state not reached at %d of %d points (largest relative rate %1.2g)'%((err>tol).sum(),npoints,err.max()))
+    print('Time elapsed: %1.1f s'%(time.time()-t0))
+    SOM[model.co2_row]=0.0
+    return pandas.DataFrame(SOM.T,columns=fields)
 
 # Run a simulation using the explicit iterator instead of the ODE solver. Can edit this function to allow more complex temperature and moisture patterns, among other things
-def run_models_iterator(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals):
+# scheme, substeps and backend select the time stepping scheme and implementation used by vector_iterate
+# If sink (an output sink from CORPSE_output) is given, returns what the sink returns instead of a list of DataFrames
+# forcing is a forcing object from CORPSE_forcing that replaces the sinusoidal cycle set by Tmin, Tmax, thetamin and thetamax
+# stats is a CORPSE_stats.SolverStats that is filled in with counts and timings of the run
+# disturbance is a CORPSE_disturbance.FireSchedule of fires to apply during the run
+# model is a CORPSE_array.CORPSEModel that sets the C types and pools (default is the default model)
+# cache is a CORPSE_cache.ResultCache, used as in run_models_ODE (not when there is a sink)
+def run_models_iterator(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals,scheme='euler',substeps=1,sink=None,forcing=None,backend='numpy',stats=None,
+                        disturbance=None,model=None,cache=None):
     # Iterate explicitly
     import time
-    from pandas import DataFrame
-    from numpy import arange
+    import CORPSE_forcing
     t0=time.time()
     
-    from numpy import cos,pi
-    T=(cos(times[:,None]*2*pi)+1)*(Tmax.values-Tmin.values)/2+Tmin.values
-    theta=(cos(times[:,None]*2*pi)+1)*(thetamax.values-thetamin.values)/2+thetamin.values
+    # Temperature and moisture are calculated at each step as they are needed, instead of for all steps at once
+    if forcing is None:
+        forcing=CORPSE_forcing.SinusoidalForcing(Tmin,Tmax,thetamin,thetamax)
     
-    dt=times[1]-times[0]
-    result_iterator=vector_iterate(initvals,params,T+273.15,theta,inputs,clay,times)
-    SOM_out_iterator=[]
-    for point in range(len(Tmin)):
-        df=DataFrame(index=times,columns=fields)
-        for field in result_iterator.keys():
-            df[field]=result_iterator[field][point,:]
-        # df['livingMicrobeN']=df['livingMicrobeC']/params['CN_microbe']
-        SOM_out_iterator.append(df)
+    if stats is None:
+        stats=CORPSE_stats.no_stats
+    model=get_model(model,params)
+    fields=model.fields
+
+    key=None
+    if cache is not None and sink is None:
+        source=params.source if isinstance(params,CORPSE_deriv.CompiledParams) else params
+        key=cache.key('run_models_iterator',times,inputs,source,clay,initvals,scheme,substeps,backend,forcing,disturbance,model)
+        if key is None:
+            print('Forcing cannot be cached, running without the cache')
+        else:
+            stored=cache.get(key)
+            if stored is not None:
+                print('Loaded from cache')
+                return stored.to_dataframes()
+
+    stats.start('run_models_iterator')
+    try:
+        result_iterator=vector_iterate(initvals,params,forcing,None,inputs,clay,times,scheme=scheme,substeps=substeps,sink=sink,backend=backend,stats=stats,
+                                       disturbance=disturbance,model=model)
+        if sink is not None:
+            print('Time elapsed: %1.1f s'%(time.time()-t0))
+            return result_iterator
+        # pandas is only needed for DataFrame output, so runs with a sink do not import it
+        from pandas import DataFrame
+        SOM_out_iterator=[]
+        with stats.timer('output'):
+            for point in range(next(iter(result_iterator.values())).shape[0]):
+                df=DataFrame(index=times,columns=fields)
+                for field in result_iterator.keys():
+                    df[field]=result_iterator[field][point,:]
+                # df['livingMicrobeN']=df['livingMicrobeC']/params['CN_microbe']
+                SOM_out_iterator.append(df)
+    finally:
+        stats.finish()
 
     print('Time elapsed: %1.1f s'%(time.time()-t0))
-    return SOM_out_iterator
+    return cache_results(cache,key,SOM_out_iterator)
 
 # Functions for adding together all the C pools. They work on either dictionary or dataframe data types because both have the same names for the pools
-def totalCarbon(SOM):
-    return SOM['uFastC']+SOM['uSlowC']+SOM['uNecroC']+SOM['pFastC']+SOM['pSlowC']+SOM['pNecroC']+SOM['livingMicrobeC']
+# model is a CORPSE_array.CORPSEModel (default is the default model)
+def totalCarbon(SOM,model=None):
+    model=get_model(model)
+    total=SOM['livingMicrobeC']
+    for t in model.chem_types:
+        total=total+SOM['u'+t+'C']+SOM['p'+t+'C']
+    return total
     
@@ -0,0 +1,218 @@
+# This file holds solver statistics, for finding out where the time goes in a slow run
+# Pass a SolverStats object to run_models_ODE, run_models_iterator, vector_iterate or integrate_batched (stats=...) and it is filled in
+# as the solver runs: numbers of rate (RHS) and Jacobian evaluations, steps and rejected steps, time spent in each stage of the
+# calculation, and optionally peak memory. Counts that differ between sites (e.g. rejected steps of the adaptive schemes, or
+# function evaluations of each site's odeint call) are also kept per site.
+#
+# Stages timed by the solvers (times are cumulative over the run, and can overlap, e.g. deriv is part of rhs):
+#   rhs:       Rate of change calculations, including converting between the solver's format and the model's
+#   deriv:     The model itself (CORPSE_deriv), within rhs, for the odeint loop. rhs minus deriv is the cost of converting formats
+#   jacobian:  Jacobian calculations
+#   forcing:   Temperature and moisture for each step (iterator)
+#   kernel:    Compiled rate and update kernels (iterator with backend='numba'), which do the work of rhs in one pass
+#   integrate: Whole ODE integrator calls
+#   output:    Storing results (output sinks and DataFrame construction)
+#
+# Without a SolverStats the solvers use no_stats, whose methods do nothing, so there is almost no overhead when statistics are not wanted
+
+# Reset the peak of traced memory. tracemalloc.reset_peak is new in python 3.9, and without it the peak is kept from when tracing started
+def reset_peak():
+    import tracemalloc
+    if hasattr(tracemalloc,'reset_peak'):
+        tracemalloc.reset_peak()
+
+class SolverStats(object):
+    '''Statistics collected while solvers run
+       trace_memory: Also record peak memory allocated through python and numpy (tracemalloc). This slows the run down, so it is off by default.
+                     Before python 3.9 the peak cannot be reset, so peaks include memory allocated before the run (or site) since tracing started
+       logger: Function that is sent a report (string) at the end of each run, for example print or logging.getLogger('CORPSE').info
+
+       Attributes (for the most recent run):
+         solver: Name of the solver
+         npoints: Number of sites
+         counts: Dictionary of totals, e.g. rhs_calls, jacobian_calls, steps, rejected_steps
+         times: Dictionary of cumulative time (seconds) spent in each stage
+         sites: Dictionary of arrays with one value per site, for counts that the solver tracks per site
+         total_time: Time for the whole run (seconds)
+         peak_bytes: Peak memory allocated during the run (None unless trace_memory)
+       runs: List of summary() dictionaries for every run so far'''
+
+    enabled=True
+
+    def __init__(self,trace_memory=False,logger=None):
+        self.trace_memory=trace_memory
+        self.logger=logger
+        self.runs=[]
+        self.depth=0
+        self.reset()
+
+    def reset(self,solver=None,npoints=0):
+        self.solver=solver
+        self.npoints=npoints
+        self.counts={}
+        self.times={}
+        self.sites={}
+        self.total_time=0.0
+        self.peak_bytes=None
+
+    def start(self,solver,npoints=0):
+        '''Called by a solver at the start of a run. Solvers that call other solvers (e.g. run_models_iterator calling vector_iterate)
+           record one run, named after the outermost solver. If the outer solver does not know the number of sites, the inner one sets it'''
+        import time,tracemalloc
+        self.depth+=1
+        if self.depth>1:
+            if not self.npoints:
+                self.npoints=npoints
+            return
+        self.reset(solver,npoints)
+        if self.trace_memory:
+            self.started_tracing=not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            reset_peak()
+        self.t0=time.perf_counter()
+
+    def finish(self):
+        '''Called by a solver at the end of a run. Records the run and sends the report to the logger.
+           Solvers call this in a finally block, so a run that fails is recorded too and the next run starts at the outermost level'''
+        import time,tracemalloc
+        self.depth-=1
+        if self.depth>0:
+            return
+        self.total_time=time.perf_counter()-self.t0
+        if self.trace_memory:
+            # site_memory resets the peak after each site, so include the peaks it recorded
+            self.peak_bytes=max(self.peak_bytes or 0,tracemalloc.get_traced_memory()[1])
+            if self.started_tracing:
+                tracemalloc.stop()
+        self.runs.append(self.summary())
+        if self.logger is not None:
+            self.logger(self.report())
+
+    def count(self,name,n=1):
+        '''Add n to a total'''
+        self.counts[name]=self.counts.get(name,0)+n
+
+    def count_sites(self,name,values,point=None):
+        '''Add to a per-site count: values for all sites (array or boolean mask), or a single value for site point. Also adds to the total'''
+        from numpy import zeros,sum
+        if name not in self.sites:
+            self.sites[name]=zeros(self.npoints,dtype=int)
+        if point is None:
+            self.sites[name]+=values
+        else:
+            self.sites[name][point]+=values
+        self.count(name,int(sum(values)))
+
+    def set_site(self,name,point,value):
+        '''Set a per-site value for site point, without adding to the totals (e.g. the share of a total that was used by one site)'''
+        from numpy import zeros
+        if name not in self.sites:
+            self.sites[name]=zeros(self.npoints,dtype=int)
+        self.sites[name][point]=value
+
+    def add_time(self,stage,seconds):
+        self.times[stage]=self.times.get(stage,0.0)+seconds
+
+    def timer(self,stage):
+        '''Context manager that adds the time spent inside it to a stage: with stats.timer('output'): ...'''
+        return StageTimer(self,stage)
+
+    def timed(self,stage,function):
+        '''Wrap a function so that each call is counted (as stage_calls) and timed'''
+        import time
+        def wrapper(*args,**kwargs):
+            t0=time.perf_counter()
+            result=function(*args,**kwargs)
+            self.times[stage]=self.times.get(stage,0.0)+time.perf_counter()-t0
+            self.counts[stage+'_calls']=self.counts.get(stage+'_calls',0)+1
+            return result
+        return wrapper
+
+    def site_memory(self,point):
+        '''Record peak memory since the last call as the peak for site point (used by solvers that run sites one at a time)'''
+        import tracemalloc
+        if not self.trace_memory:
+            return
+        if 'peak_bytes' not in self.sites:
+            from numpy import zeros
+            self.sites['peak_bytes']=zeros(self.npoints,dtype=int)
+        self.sites['peak_bytes'][point]=tracemalloc.get_traced_memory()[1]
+        self.peak_bytes=max(self.peak_bytes or 0,self.sites['peak_bytes'][point])
+        reset_peak()
+
+    def summary(self):
+        '''Dictionary of the statistics of the most recent run (per-site arrays are copied)'''
+        return {'solver':self.solver,'npoints':self.npoints,'counts':dict(self.counts),'times':dict(self.times),
+                'sites':dict([(k,v.copy()) for k,v in self.sites.items()]),'total_time':self.total_time,'peak_bytes':self.peak_bytes}
+
+    def report(self):
+        '''Readable summary of the most recent run'''
+        lines=['%s: %d sites, %1.3f s'%(self.solver,self.npoints,self.total_time)]
+        for stage in sorted(self.times,key=self.times.get,reverse=True):
+            lines.append('  %-12s %10.3f s %5.1f%%'%(stage,self.times[stage],100*self.times[stage]/max(self.total_time,1e-300)))
+        for name in sorted(self.counts):
+            line='  %-16s %12d'%(name,self.counts[name])
+            if name in self.sites and self.npoints>1:
+                line+='  (per site: min %d, max %d)'%(self.sites[name].min(),self.sites[name].max())
+            lines.append(line)
+        if self.peak_bytes is not None:
+            lines.append('  %-16s %12.1f MB'%('peak memory',self.peak_bytes/1e6))
+        return '\n'.join(lines)
+
+class StageTimer(object):
+    def __init__(self,stats,stage):
+        self.stats=stats
+        self.stage=stage
+
+    def __enter__(self):
+        import time
+        self.t0=time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        import time
+        self.stats.add_time(self.stage,time.perf_counter()-self.t0)
+        return False
+
+
+# Used by the solvers when no statistics are wanted. Every method does nothing
+class NoStats(object):
+    enabled=False
+
+    def start(self,solver,npoints=0):
+        pass
+
+    def finish(self):
+        pass
+
+    def count(self,name,n=1):
+        pass
+
+    def count_sites(self,name,values,point=None):
+        pass
+
+    def set_site(self,name,point,value):
+        pass
+
+    def add_time(self,stage,seconds):
+        pass
+
+    def timer(self,stage):
+        return null_timer
+
+    def timed(self,stage,function):
+        return function
+
+    def site_memory(self,point):
+        pass
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        return False
+
+null_timer=NullTimer()
+no_stats=NoStats()
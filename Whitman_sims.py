@@ -1,4 +1,3 @@
-import pandas
 import CORPSE_array
 import CORPSE_solvers
 from numpy import array,arange
@@ -71,41 +70,50 @@ paramsets['Slow-growing survivor']=copy.deepcopy(params)
 paramsets['Slow-growing survivor']['vmaxref']['Fast']=6.0      # Slower decomposition/growth rate
 
 
-# Set up a data structure to hold the results of the different simulations
-results={}
-# Goes through each functional type and runs a simulation using the appropriate set of parameters and initial values
+# Run the incubation simulation for each functional type
 # Simulations are assuming a constant temperature of 20 C and constant moisture of 60% of saturation
 # Inputs are empty because this is running as an incubation without any constant inputs of C
-for functype in initvals:
-    results[functype] = CORPSE_solvers.run_models_ODE(Tmin=20.0,Tmax=20.0,thetamin=0.6,thetamax=0.6,
-                                            times=t,inputs={},clay=20.0,initvals=initvals[functype],params=paramsets[functype])
-
-
-# This section plots the results
-# Each set of results should have the same set of pools as the initial values structure from the beginning of the simulation
-from matplotlib import pyplot
-
-fig,ax=pyplot.subplots(nrows=2,ncols=1,clear=True,num='CORPSE results')
-for sim in results:
-    totalC=CORPSE_array.sumCtypes(results[sim][0], 'u')+CORPSE_array.sumCtypes(results[sim][0], 'p')
-    ax[0].plot(t*365,results[sim][0]['CO2'].diff()/totalC[0]*100,label=sim)
-
-    # ax[1].plot(t*365,results[sim][0]['uFastC'],label='Simple')
-    # ax[1].plot(t*365,results[sim][0]['uSlowC'],label='Complex')
-    # ax[1].plot(t*365,results[sim][0]['uNecroC'],label='Necromass')
-
-    ax[1].plot(t*365,results[sim][0]['livingMicrobeC']/totalC[0]*100)
-
-ax[0].set_xlabel('Time (days)')
-ax[1].set_xlabel('Time (days)')
-# ax[2].set_xlabel('Time (days)')
-ax[0].set_ylabel('CO$_2$ flux rate (% initial C/day)')
-ax[1].set_ylabel('Microbial biomass (% initial C)')
-# ax[1].set_ylabel('SOM pools')
-# ax[1].legend()
-ax[0].legend(fontsize='medium')
-ax[0].set_title('CO$_2$ fluxes')
-ax[1].set_title('Microbial biomass')
-
-pyplot.show()
-
+# Returns a dictionary of functional type: output of run_models_ODE
+def run_simulations():
+    # Set up a data structure to hold the results of the different simulations
+    results={}
+    # Goes through each functional type and runs a simulation using the appropriate set of parameters and initial values
+    for functype in initvals:
+        results[functype] = CORPSE_solvers.run_models_ODE(Tmin=20.0,Tmax=20.0,thetamin=0.6,thetamax=0.6,
+                                                times=t,inputs={},clay=20.0,initvals=initvals[functype],params=paramsets[functype])
+    return results
+
+# Plot CO2 fluxes and microbial biomass from the results of run_simulations. Returns the figure
+# matplotlib is only imported here, so other scripts can use the functional types above without it
+def plot_results(results):
+    # Each set of results should have the same set of pools as the initial values structure from the beginning of the simulation
+    from matplotlib import pyplot
+
+    fig,ax=pyplot.subplots(nrows=2,ncols=1,clear=True,num='CORPSE results')
+    for sim in results:
+        totalC=CORPSE_array.sumCtypes(results[sim][0], 'u')+CORPSE_array.sumCtypes(results[sim][0], 'p')
+        ax[0].plot(t*365,results[sim][0]['CO2'].diff()/totalC[0]*100,label=sim)
+
+        # ax[1].plot(t*365,results[sim][0]['uFastC'],label='Simple')
+        # ax[1].plot(t*365,results[sim][0]['uSlowC'],label='Complex')
+        # ax[1].plot(t*365,results[sim][0]['uNecroC'],label='Necromass')
+
+        ax[1].plot(t*365,results[sim][0]['livingMicrobeC']/totalC[0]*100)
+
+    ax[0].set_xlabel('Time (days)')
+    ax[1].set_xlabel('Time (days)')
+    # ax[2].set_xlabel('Time (days)')
+    ax[0].set_ylabel('CO$_2$ flux rate (% initial C/day)')
+    ax[1].set_ylabel('Microbial biomass (% initial C)')
+    # ax[1].set_ylabel('SOM pools')
+    # ax[1].legend()
+    ax[0].legend(fontsize='medium')
+    ax[0].set_title('CO$_2$ fluxes')
+    ax[1].set_title('Microbial biomass')
+    return fig
+
+# The functional types above are also used by other scripts (e.g. CORPSE_benchmarks.py), so only run the simulations when this file is run as a script
+if __name__=='__main__':
+    from matplotlib import pyplot
+    plot_results(run_simulations())
+    pyplot.show()
@@ -0,0 +1,39 @@
+# Checks the result cache in CORPSE_cache
+
+import copy
+import numpy
+import CORPSE_cache
+import CORPSE_solvers
+import Whitman_sims
+
+
+def run(cache,params,clay):
+    return CORPSE_solvers.run_models_ODE(20.0,20.0,0.5,0.5,numpy.arange(0,10/365,1/365),{},params,clay,Whitman_sims.SOM_init,batched=True,cache=cache)
+
+def test_same_values_same_key(tmp_path):
+    cache=CORPSE_cache.ResultCache(str(tmp_path))
+    params=copy.deepcopy(Whitman_sims.params)
+    # A list parameter is turned into an array by check_params during the first run, and clay is given as different number types
+    params['Tmic']=[0.1,0.2,0.3]
+    first=run(cache,params,20)
+    run(cache,params,20.0)
+    run(cache,params,numpy.float64(20))
+    assert (cache.misses,cache.hits)==(1,2)
+    assert CORPSE_cache.ResultCache(str(tmp_path)).key(True)!=CORPSE_cache.ResultCache(str(tmp_path)).key(1.0)
+    params['Tmic']=[0.1,0.2,0.4]
+    run(cache,params,20)
+    assert cache.misses==2
+    assert len(first)==3
+
+def test_hits_are_memory_mapped(tmp_path):
+    cache=CORPSE_cache.ResultCache(str(tmp_path))
+    params=copy.deepcopy(Whitman_sims.params)
+    computed=run(cache,params,20.0)
+    loaded=run(cache,params,20.0)
+    assert cache.hits==1
+    numpy.testing.assert_array_equal(loaded[0].values,computed[0].values)
+    # The run is the only entry in the cache
+    [(used,size,key)]=cache.entries()
+    store=cache.get(key)
+    assert store is not None
+    assert numpy.shares_memory(store.site_dataframe(0).values,store.data)
@@ -0,0 +1,22 @@
+# Checks running a configuration with the corpse command's run function
+
+import copy
+import numpy
+import CORPSE_cli
+import Whitman_sims
+
+
+def config(solver,output):
+    params=copy.deepcopy(Whitman_sims.params)
+    # Per-site parameters with scalar climate and clay set the number of sites
+    params['Tmic']=[0.1,0.2,0.3,0.4,0.5]
+    initvals=dict([(f,float(v)) for f,v in Whitman_sims.SOM_init.items()])
+    initvals['originalC']=0.0
+    return {'output':str(output),'solver':solver,'times':{'start':0.0,'end':0.1,'step':0.01},'params':params,'initvals':initvals}
+
+def test_per_site_params(tmp_path):
+    stores=[CORPSE_cli.run(config(solver,tmp_path/solver)) for solver in ['ode','iterator']]
+    for store in stores:
+        assert len(store.site_ids)==5
+    mic=stores[0].pool('livingMicrobeC')
+    assert not numpy.allclose(mic[0],mic[4])
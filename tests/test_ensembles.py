@@ -0,0 +1,60 @@
+# Checks runs with parameters that have one value per point (e.g. a calibration ensemble), with scalar climate and clay
+
+import copy
+import numpy
+import pytest
+import CORPSE_array
+import CORPSE_solvers
+import Whitman_sims
+
+
+def ensemble_params(values):
+    params=copy.deepcopy(Whitman_sims.params)
+    params['Tmic']=numpy.array(values)
+    return params
+
+def forcing():
+    return {'Tmin':10.0,'Tmax':20.0,'thetamin':0.4,'thetamax':0.6,'times':numpy.arange(0,30/365,1/365),'clay':20.0}
+
+def test_check_params_npoints():
+    params=ensemble_params([0.1,0.2,0.3])
+    assert CORPSE_array.check_params(params,None)==3
+    assert CORPSE_array.check_params(params,3)==3
+    # One point is a known number of points, not a request to infer it
+    with pytest.raises(ValueError):
+        CORPSE_array.check_params(params,1)
+    assert CORPSE_array.check_params(copy.deepcopy(Whitman_sims.params),1)==1
+
+def test_run_ensemble_per_point_params():
+    f=forcing()
+    params=ensemble_params([0.1,0.2,0.3])
+    results,errors=CORPSE_solvers.run_ensemble({'ens':(params,Whitman_sims.SOM_init,f)},max_workers=1)
+    assert errors=={}
+    assert len(results['ens'])==3
+    expected=CORPSE_solvers.run_models_ODE(f['Tmin'],f['Tmax'],f['thetamin'],f['thetamax'],f['times'],{},params,f['clay'],
+                                           Whitman_sims.SOM_init,batched=True)
+    for got,exp in zip(results['ens'],expected):
+        numpy.testing.assert_allclose(got.values,exp[got.columns].values,rtol=1e-6,atol=1e-9)
+    # The members differ, so each point used its own parameter value
+    assert not numpy.allclose(results['ens'][0]['livingMicrobeC'].values,results['ens'][2]['livingMicrobeC'].values)
+
+def test_vector_iterate_scalar_forcing():
+    times=numpy.arange(0,30/365,1/365)
+    params=ensemble_params([0.1,0.2,0.3])
+    result=CORPSE_solvers.vector_iterate(Whitman_sims.SOM_init,params,293.15,0.5,{},20.0,times,scheme='rk4',substeps=4)
+    assert result['livingMicrobeC'].shape==(3,len(times))
+    for point,Tmic in enumerate([0.1,0.2,0.3]):
+        single=ensemble_params(Tmic)
+        expected=CORPSE_solvers.vector_iterate(Whitman_sims.SOM_init,single,293.15,0.5,{},20.0,times,scheme='rk4',substeps=4)
+        numpy.testing.assert_allclose(result['livingMicrobeC'][point],expected['livingMicrobeC'][0],rtol=1e-12)
+
+# The per-point odeint loop compiles each point's parameters with that point's clay
+def test_loop_matches_batched_per_point_clay():
+    f=forcing()
+    clay=numpy.array([5.0,20.0,40.0])
+    loop=CORPSE_solvers.run_models_ODE(f['Tmin'],f['Tmax'],f['thetamin'],f['thetamax'],f['times'],{},Whitman_sims.params,clay,Whitman_sims.SOM_init)
+    batched=CORPSE_solvers.run_models_ODE(f['Tmin'],f['Tmax'],f['thetamin'],f['thetamax'],f['times'],{},Whitman_sims.params,clay,Whitman_sims.SOM_init,
+                                          batched=True)
+    for a,b in zip(loop,batched):
+        numpy.testing.assert_allclose(a.values,b[a.columns].values,rtol=1e-5,atol=1e-8)
+    assert not numpy.allclose(loop[0]['pFastC'].values,loop[2]['pFastC'].values)
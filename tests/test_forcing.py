@@ -0,0 +1,32 @@
+# Checks the forcing objects in CORPSE_forcing
+
+import numpy
+import CORPSE_forcing
+
+
+def quarterly(**kwargs):
+    times=numpy.arange(0,1,0.25)
+    T=numpy.array([[0.0,5.0],[10.0,5.0],[20.0,5.0],[30.0,5.0]])
+    return CORPSE_forcing.GriddedForcing(times,T,T/100,**kwargs)
+
+def test_periodic_linear_wraps_to_first_record():
+    forcing=quarterly(period=1.0)
+    for time,expected in [(0.5,20.0),(0.875,15.0),(1.125,5.0),(2.875,15.0)]:
+        T,theta=forcing.at(time)
+        numpy.testing.assert_allclose(T-273.15,[expected,5.0],atol=1e-12)
+        numpy.testing.assert_allclose(theta,numpy.array([expected,5.0])/100,atol=1e-12)
+    # Times on records use the record, and the key repeats every period
+    forcing.at(0.25)
+    key=forcing.key
+    forcing.at(3.25)
+    assert forcing.key==key==1
+
+def test_without_period_holds_last_record():
+    forcing=quarterly()
+    T,theta=forcing.at(0.875)
+    numpy.testing.assert_allclose(T-273.15,[30.0,5.0])
+
+def test_periodic_previous():
+    forcing=quarterly(period=1.0,method='previous')
+    T,theta=forcing.at(1.875)
+    numpy.testing.assert_allclose(T-273.15,[30.0,5.0])
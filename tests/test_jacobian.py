@@ -0,0 +1,81 @@
+# Checks the analytic Jacobian (CORPSE_jacobian) against central differences of the rate function (CORPSE_deriv_array)
+
+import copy
+import numpy
+import CORPSE_array
+import Whitman_sims
+
+
+# Central difference Jacobian of CORPSE_deriv_array, shape (npoints,n_pools,n_pools) like CORPSE_jacobian
+def finite_difference_jacobian(SOM,T,theta,params,claymod,model):
+    npools,npoints=SOM.shape
+    J=numpy.zeros((npoints,npools,npools))
+    for j in range(npools):
+        h=1e-6*numpy.maximum(abs(SOM[j]),1e-3)
+        up=SOM.copy()
+        up[j]+=h
+        down=SOM.copy()
+        down[j]-=h
+        diff=CORPSE_array.CORPSE_deriv_array(up,T,theta,params,claymod,model=model)-CORPSE_array.CORPSE_deriv_array(down,T,theta,params,claymod,model=model)
+        J[:,:,j]=(diff/(2*h)).T
+    return J
+
+def check_jacobian(SOM,T,theta,params,claymod=1.0,model=None):
+    model=model or CORPSE_array.default_model
+    J=CORPSE_array.CORPSE_jacobian(SOM,T,theta,params,claymod,model=model)
+    Jfd=finite_difference_jacobian(SOM,T,theta,params,claymod,model)
+    for point in range(SOM.shape[1]):
+        scale=abs(Jfd[point]).max()
+        numpy.testing.assert_allclose(J[point],Jfd[point],rtol=1e-5,atol=1e-7*scale,err_msg='point %d'%point)
+
+# Whitman_sims initial pools for npoints points, as a state array
+def whitman_state(npoints):
+    SOM=CORPSE_array.pools_to_array(dict([(f,numpy.zeros(npoints)+float(v)) for f,v in Whitman_sims.SOM_init.items()]))
+    SOM[CORPSE_array.pool_index['originalC']]=SOM[CORPSE_array.u_rows].sum(axis=0)
+    return SOM
+
+def test_points_and_per_point_params():
+    npoints=4
+    params=copy.deepcopy(Whitman_sims.params)
+    params['vmaxref']['Fast']=numpy.array([5.0,9.0,12.0,18.0])
+    params['Tmic']=numpy.array([0.1,0.25,0.5,1.0])
+    params['kC']['Slow']=numpy.array([0.005,0.01,0.02,0.05])
+    clay=numpy.array([5.0,20.0,35.0,50.0])
+    compiled=CORPSE_array.CompiledParams(params,clay=clay)
+    SOM=whitman_state(npoints)
+    SOM[CORPSE_array.mic_row]=[0.06,0.5,1.0,2.0]
+    check_jacobian(SOM,numpy.array([275.0,285.0,293.15,305.0]),numpy.array([0.2,0.5,0.6,0.9]),compiled,compiled.claymod)
+
+def test_zero_biomass():
+    # The state after a fire that kills all the microbes. Decomposition is smooth in biomass here, so the mic column is not zero
+    SOM=whitman_state(1)
+    SOM[CORPSE_array.mic_row]=0.0
+    compiled=CORPSE_array.CompiledParams(Whitman_sims.params)
+    J=CORPSE_array.CORPSE_jacobian(SOM,293.15,0.6,compiled)
+    assert (J[0,CORPSE_array.u_rows,CORPSE_array.mic_row]<0).all()
+    check_jacobian(SOM,293.15,0.6,compiled)
+
+def test_zero_unprotected_carbon():
+    SOM=whitman_state(2)
+    SOM[CORPSE_array.pool_index['uFastC'],0]=0.0
+    SOM[CORPSE_array.u_rows,1]=0.0
+    check_jacobian(SOM,293.15,0.6,CORPSE_array.CompiledParams(Whitman_sims.params))
+
+def test_both_sides_of_turnover_clamp():
+    # Turnover is max((mic-minMicrobeC*sumU)/Tmic,0), so check biomass above and below minMicrobeC*sumU
+    SOM=whitman_state(2)
+    threshold=Whitman_sims.params['minMicrobeC']*SOM[CORPSE_array.u_rows].sum(axis=0)
+    SOM[CORPSE_array.mic_row]=threshold*numpy.array([1.5,0.5])
+    check_jacobian(SOM,293.15,0.6,CORPSE_array.CompiledParams(Whitman_sims.params))
+
+def test_model_with_extra_c_type():
+    model=CORPSE_array.CORPSEModel(['Fast','Slow','Necro','Pyrogenic'])
+    params=copy.deepcopy(Whitman_sims.params)
+    for name,value in [('vmaxref',0.05),('Ea',40e3),('kC',0.01),('eup',0.02),('protection_rate',0.01)]:
+        params[name]['Pyrogenic']=value
+    SOM=numpy.zeros((len(model.array_pools),3))
+    for f,v in Whitman_sims.SOM_init.items():
+        SOM[model.pool_index[f]]=float(v)
+    SOM[model.pool_index['uPyrogenicC']]=[3.0,0.0,1.0]
+    SOM[model.mic_row]=[0.06,0.3,0.0]
+    check_jacobian(SOM,290.0,0.5,model.compile(params,clay=25.0),model=model)
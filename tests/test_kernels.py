@@ -0,0 +1,76 @@
+# Checks the kernels in CORPSE_kernels against the numpy versions (CORPSE_deriv_array, and advance_rk4 in CORPSE_solvers)
+# Without numba the kernels run as plain python, so these tests check the same calculation either way
+
+import copy
+import numpy
+import CORPSE_array
+import CORPSE_kernels
+import CORPSE_solvers
+import Whitman_sims
+
+
+# State, temperature, moisture, compiled parameters and (n_pools,npoints) input rates for a set of test points, including
+# points with zero microbial biomass and zero unprotected C, and parameters and clay that differ between points
+def setup_points(model):
+    npoints=5
+    params=copy.deepcopy(Whitman_sims.params)
+    for name,value in [('vmaxref',0.05),('Ea',40e3),('kC',0.01),('eup',0.02),('protection_rate',0.01)]:
+        for t in model.chem_types:
+            params[name].setdefault(t,value)
+    params['vmaxref']['Fast']=numpy.array([5.0,9.0,12.0,18.0,9.0])
+    params['Tmic']=numpy.array([0.1,0.25,0.5,1.0,0.25])
+    compiled=model.compile(params,clay=numpy.array([5.0,20.0,35.0,50.0,20.0]))
+    SOM=numpy.zeros((len(model.array_pools),npoints))
+    for n,t in enumerate(model.chem_types):
+        SOM[model.u_rows.start+n]=5.0/(n+1)
+        SOM[model.p_rows.start+n]=2.0/(n+1)
+    SOM[model.mic_row]=[0.06,0.5,0.0,1.0,0.2]
+    SOM[model.u_rows,4]=0.0
+    input_rates=numpy.zeros_like(SOM)
+    input_rates[model.pool_index['uFastC']]=0.4
+    input_rates[model.pool_index['uSlowC']]=numpy.linspace(0.0,1.0,npoints)
+    T=numpy.array([275.0,285.0,293.15,300.0,290.0])
+    theta=numpy.array([0.2,0.5,0.6,0.9,0.4])
+    return SOM,T,theta,compiled,input_rates
+
+def numpy_rate(T,theta,compiled,input_rates):
+    def rate(y,out):
+        CORPSE_array.CORPSE_deriv_array(y,T,theta,compiled,compiled.claymod,out=out)
+        numpy.add(out,input_rates,out=out)
+        return out
+    return rate
+
+def kernel_arguments(SOM,T,theta,compiled,input_rates):
+    npoints=SOM.shape[1]
+    work=numpy.empty((compiled.model.nchem,npoints))
+    vmax=numpy.broadcast_to(compiled.vmax(T,out=work),work.shape)
+    moisture=CORPSE_kernels.moisture_array(theta,compiled.arrays,compiled.aerobic_max,out=numpy.empty(npoints))
+    return (vmax,moisture,CORPSE_kernels.kernel_inputs(input_rates),CORPSE_kernels.kernel_params(compiled,npoints),
+            CORPSE_kernels.kernel_layout(compiled.model))
+
+def check_model(model):
+    SOM,T,theta,compiled,input_rates=setup_points(model)
+    rate=numpy_rate(T,theta,compiled,input_rates)
+    vmax,moisture,inputs,kp,layout=kernel_arguments(SOM,T,theta,compiled,input_rates)
+
+    expected=rate(SOM,numpy.empty_like(SOM))
+    got=CORPSE_kernels.rates(SOM,vmax,moisture,inputs,kp,layout,numpy.empty_like(SOM))
+    numpy.testing.assert_allclose(got,expected,rtol=1e-12,atol=1e-14)
+
+    dt=1/365
+    expected=SOM+dt*rate(SOM,numpy.empty_like(SOM))
+    got=SOM.copy()
+    CORPSE_kernels.euler_step(got,dt,vmax,moisture,inputs,kp,layout,numpy.empty_like(SOM))
+    numpy.testing.assert_allclose(got,expected,rtol=1e-12,atol=1e-14)
+
+    expected=SOM.copy()
+    CORPSE_solvers.advance_rk4(expected,rate,0.1,4,{})
+    got=SOM.copy()
+    CORPSE_kernels.rk4_step(got,0.1,4,vmax,moisture,inputs,kp,layout,*[numpy.empty_like(SOM) for n in range(5)])
+    numpy.testing.assert_allclose(got,expected,rtol=1e-12,atol=1e-14)
+
+def test_default_model():
+    check_model(CORPSE_array.default_model)
+
+def test_model_with_extra_c_type():
+    check_model(CORPSE_array.CORPSEModel(['Fast','Slow','Necro','Pyrogenic']))
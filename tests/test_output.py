@@ -0,0 +1,25 @@
+# Checks the output sinks in CORPSE_output against the full output of vector_iterate
+
+import numpy
+import CORPSE_output
+import CORPSE_solvers
+import Whitman_sims
+
+
+def run(sink=None):
+    times=numpy.arange(0,3,1/365)
+    return times,CORPSE_solvers.vector_iterate(Whitman_sims.SOM_init,Whitman_sims.params,293.15,0.5,{},20.0,times,sink=sink)
+
+def test_aggregate_delta_starts_from_initial_state():
+    times,full=run()
+    agg=run(CORPSE_output.AggregateOutput(1.0,'delta'))[1]
+    # Output at step k is the state at the end of the step, so the last step of each year holds the total at the end of the year
+    ends=full['CO2'][:,[364,729,1094]]
+    expected=numpy.diff(numpy.concatenate([Whitman_sims.SOM_init['CO2']+numpy.zeros((1,1)),ends],axis=1),axis=1)
+    numpy.testing.assert_allclose(agg['CO2'],expected,rtol=1e-12)
+
+def test_aggregate_mean_and_last():
+    times,full=run()
+    agg=run(CORPSE_output.AggregateOutput(1.0,{'uFastC':'mean','livingMicrobeC':'last'},fields=['uFastC','livingMicrobeC']))[1]
+    numpy.testing.assert_allclose(agg['uFastC'][:,0],full['uFastC'][:,:365].mean(axis=1),rtol=1e-12)
+    numpy.testing.assert_allclose(agg['livingMicrobeC'][:,1],full['livingMicrobeC'][:,729],rtol=1e-12)
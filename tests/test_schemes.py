@@ -0,0 +1,88 @@
+# Checks the time stepping schemes of the iterator (advance_rk4, advance_embedded and advance_rosenbrock in CORPSE_solvers)
+# against exact solutions of a linear problem and against the ODE integrator, and the evaluation of subsets of points they use
+
+import copy
+import numpy
+import CORPSE_array
+import CORPSE_solvers
+import Whitman_sims
+from test_kernels import setup_points
+
+
+# Linear decay y'=-rate*y with a different rate at each point, from stiff to slow, so points finish their intervals at different times.
+# Returns the rate and Jacobian functions in the form the schemes call them, and a list of the cols each rate call was given
+def decay_problem(rates):
+    calls=[]
+    def rate(y,out,cols=None):
+        calls.append(cols)
+        k=rates if cols is None else rates[cols]
+        numpy.multiply(y,-k,out=out)
+        return out
+    def jac(y,cols=None):
+        k=rates if cols is None else rates[cols]
+        return -k[:,None,None]*numpy.eye(y.shape[0])
+    return rate,jac,calls
+
+# Rates are chosen so that no first step has h*rate=-1, where the rk23 error estimate of linear decay happens to be zero
+rates=numpy.array([0.2,2.0,15.0,60.0])
+
+def decay_error(advance):
+    y0=numpy.array([[1.0,1.0,1.0,1.0],[2.0,0.5,3.0,1.0]])
+    y=y0.copy()
+    for n in range(4):
+        advance(y)
+    return abs(y-y0*numpy.exp(-rates*0.4)).max()
+
+def test_rk4_converges_at_fourth_order():
+    rate,jac,calls=decay_problem(rates)
+    errors=[decay_error(lambda y: CORPSE_solvers.advance_rk4(y,rate,0.1,nsub,{})) for nsub in [8,16]]
+    assert 12<errors[0]/errors[1]<20
+
+def check_adaptive(advance,rtols=(1e-5,1e-8)):
+    rate,jac,calls=decay_problem(rates)
+    errors=[]
+    for rtol in rtols:
+        ws={}
+        errors.append(decay_error(lambda y: advance(y,rate,jac,rtol,ws)))
+        assert errors[-1]<rtol*100
+    assert errors[1]<errors[0]
+    # Points that finished their interval early were not evaluated again
+    subsets=[c for c in calls if c is not None]
+    assert subsets and all(len(c)<len(rates) for c in subsets)
+
+def test_embedded_schemes():
+    for name,tableau in CORPSE_solvers.embedded_tableaux.items():
+        check_adaptive(lambda y,rate,jac,rtol,ws: CORPSE_solvers.advance_embedded(y,rate,0.1,tableau,rtol,rtol*1e-3,ws))
+
+# The error estimate of the second order Rosenbrock scheme needs many more steps for tight tolerances
+def test_rosenbrock():
+    check_adaptive(lambda y,rate,jac,rtol,ws: CORPSE_solvers.advance_rosenbrock(y,rate,jac,0.1,1,rtol,rtol*1e-3,ws),rtols=(1e-3,1e-5))
+
+# With constant temperature and moisture the iterator's only error is from time stepping, so every scheme converges to the ODE integrator
+def test_schemes_match_ode_integrator():
+    params=copy.deepcopy(Whitman_sims.params)
+    params['Tmic']=numpy.array([0.1,0.25,0.5])
+    clay=numpy.array([5.0,20.0,40.0])
+    times=numpy.arange(0,20/365,1/365)
+    ivals=CORPSE_solvers.initvals_array(Whitman_sims.SOM_init,3)
+    reference=CORPSE_solvers.integrate_batched(20.0,20.0,0.5,0.5,times,{'uFastC':1.0},params,clay,ivals,rtol=1e-11,atol=1e-11)
+    fields=CORPSE_solvers.fields
+    for scheme,kwargs,tol in [('rk4',{'substeps':10},1e-8),('rk23',{'rtol':1e-9,'atol':1e-12},1e-7),('rk45',{'rtol':1e-9,'atol':1e-12},1e-8),
+                              ('rosenbrock',{'rtol':1e-6,'atol':1e-9},1e-5)]:
+        out=CORPSE_solvers.vector_iterate(Whitman_sims.SOM_init,params,293.15,0.5,{'uFastC':1.0},clay,times,scheme=scheme,**kwargs)
+        # Output k is the state at times[k+1]
+        for n,f in enumerate(fields):
+            numpy.testing.assert_allclose(out[f][:,:-1],reference[:,1:,n],rtol=tol,atol=tol,err_msg='%s %s'%(scheme,f))
+
+# The adaptive schemes evaluate only the points that have not finished their interval, with CompiledParams.columns
+def test_columns():
+    for model in [CORPSE_array.default_model,CORPSE_array.CORPSEModel(['Fast','Slow','Necro','Pyrogenic'])]:
+        SOM,T,theta,compiled,input_rates=setup_points(model)
+        cols=numpy.array([1,2,4])
+        sub=compiled.columns(cols,SOM.shape[1])
+        expected=CORPSE_array.CORPSE_deriv_array(SOM,T,theta,compiled,compiled.claymod)[:,cols]
+        got=CORPSE_array.CORPSE_deriv_array(SOM[:,cols],T[cols],theta[cols],sub,sub.claymod)
+        numpy.testing.assert_allclose(got,expected,rtol=1e-12,atol=1e-14)
+        expected=CORPSE_array.CORPSE_jacobian(SOM,T,theta,compiled,compiled.claymod)[cols]
+        got=CORPSE_array.CORPSE_jacobian(SOM[:,cols],T[cols],theta[cols],sub,sub.claymod)
+        numpy.testing.assert_allclose(got,expected,rtol=1e-12,atol=1e-14)
@@ -0,0 +1,34 @@
+# Checks the solver statistics in CORPSE_stats
+
+import numpy
+import pytest
+import CORPSE_solvers
+import CORPSE_stats
+import Whitman_sims
+
+
+def run_iterator(stats,scheme='euler'):
+    return CORPSE_solvers.run_models_iterator(20.0,20.0,0.5,0.5,numpy.arange(0,10/365,1/365),{},Whitman_sims.params,20.0,Whitman_sims.SOM_init,
+                                              scheme=scheme,stats=stats)
+
+def test_failed_run_does_not_stop_recording():
+    reports=[]
+    stats=CORPSE_stats.SolverStats(logger=reports.append)
+    with pytest.raises(ValueError):
+        run_iterator(stats,scheme='bogus')
+    assert stats.depth==0
+    run_iterator(stats)
+    assert stats.depth==0
+    assert stats.runs[-1]['solver']=='run_models_iterator'
+    assert stats.runs[-1]['counts']['steps']==10
+    assert len(reports)==len(stats.runs)
+
+def test_trace_memory(monkeypatch):
+    import tracemalloc
+    stats=CORPSE_stats.SolverStats(trace_memory=True)
+    run_iterator(stats)
+    assert stats.peak_bytes>0
+    # Python before 3.9 has no tracemalloc.reset_peak
+    monkeypatch.delattr(tracemalloc,'reset_peak',raising=False)
+    run_iterator(stats)
+    assert stats.peak_bytes>0